@@ -1,53 +1,58 @@
-from DBcontrol import connect
-import sqlite3
-import pandas as pd
+from DBcontrol import reader, writer, add_hashes, insert_song, retrieve_song_id, invalidate_song_cache
+import fingerprint_index
+from search import invalidate_result_cache
 from cm_helper import preprocess_audio
 from hasher import create_hashes
 from const_map import create_constellation_map
-import librosa
 
-# TODO: Implement this function to check if a song with the given YouTube URL already exists in the database
 def check_if_song_exists(youtube_url: str) -> bool:
-    with connect() as con:
+    with reader() as con:
         cur = con.cursor()
         
-        # TODO: Write a SQL query to count how many songs have the given YouTube URL
-        query = None
+        # count how many songs have the given YouTube URL
+        query = "SELECT COUNT(*) FROM songs WHERE youtube_url = ?"
         cur.execute(query, (youtube_url,))
         count = cur.fetchone()[0]
         return count > 0
     
 def add_song(track_info: dict, resample_rate: None|int = 11025) -> int:
-    with connect() as con:
+    """
+    inserts the song (see `DBcontrol.add_song()` for `track_info`) and its fingerprints,
+    returns its song id. A song whose youtube_url is already in the library is not added again
+
+    keeps the caches of this process in sync: the fingerprint index (if one was loaded),
+    the song metadata cache and the query result cache
+    """
+    # a known url is not fingerprinted (the insert below is what guarantees it is not added twice)
+    song_id = retrieve_song_id(track_info["youtube_url"])
+    if song_id is not None:
+        return song_id
+
+    # get the hashes for this song first, so a file that cannot be decoded adds nothing.
+    # The audio is usually a temporary download, not worth keeping in the audio cache
+    audio, sr = preprocess_audio(track_info["audio_path"], sr=resample_rate, use_cache=False)
+    constellation_map = create_constellation_map(audio, sr)
+    hashes = create_hashes(constellation_map, sr)
+
+    # the song row and its hashes are one transaction: when concurrent requests add the
+    # same url, the unique youtube_url lets one insert the song and the others return its
+    # id without adding (and counting in hash_df) the hashes again
+    with writer() as con:
         cur = con.cursor()
+        song_id = insert_song(track_info, cur)
+        if song_id is None:
+            cur.execute("SELECT id FROM songs WHERE youtube_url = ?", (track_info["youtube_url"],))
+            return int(cur.fetchone()[0])
 
-        # get the duration of the audio file
-        audio_path = track_info["audio_path"]
-        duration_s = librosa.get_duration(path=audio_path)
-        
-        # TODO: Insert the song metadata into the songs table
-        query = None
-        data = None
-        cur.execute(query, data)
-        con.commit()
+        # insert the hashes, and count the song in the hash document-frequency table
+        add_hashes(hashes, song_id, con)
 
-        # select the last inserted song id
-        cur.execute("SELECT last_insert_rowid()")
-        song_id = cur.fetchone()[0]
-        
-        # get the hashes for this song
-        audio, sr = preprocess_audio(track_info["audio_path"], sr=resample_rate)
-        constellation_map = create_constellation_map(audio, sr)
-        hashes = create_hashes(constellation_map, song_id, sr)
-        
-        # TODO: Insert the hashes into the fingerprints table
-        # HINT: can use the same query string 
-        #       as DBcontrol.py:add_hash()
-        for address, (anchorT, song_id) in hashes.items():
-            query = None
-            data = None
-            cur.execute(query, data)
-        con.commit()
-        
-        return song_id
-        
\ No newline at end of file
+    # a reused id must not be answered from the metadata of a deleted song
+    invalidate_song_cache([song_id])
+    # keep the fingerprint index (if one was loaded) in sync with the database
+    if fingerprint_index.index is not None:
+        fingerprint_index.index.add(song_id, hashes)
+    # cached query results do not know the new song
+    invalidate_result_cache()
+
+    return song_id
@@ -1,26 +1,212 @@
 import os
+import time
+import threading
+import contextlib
 
 import sqlite3
 import librosa
-import pandas as pd
+import numpy as np
 from pathlib import Path
+from collections import defaultdict, OrderedDict
+from itertools import repeat, islice
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from dataloader import load
+import metrics
 
-from cm_helper import preprocess_audio
-from hasher import create_hashes
-from const_map import create_constellation_map
+from cm_helper import read_audio_blocks, audio_sampling_rate
+from hasher import create_hashes, stream_hashes
+from const_map import stream_constellation_map, constellation_map_from_file
 
 library = "sql/library.db"
 
+# layout of the hashes table used by create_tables():
+# "heap":      rowid table + secondary index on hash_val (sql/schema.sql),
+#              a lookup reads the index, then jumps to the table row
+# "clustered": WITHOUT ROWID table with primary key (hash_val, song_id, time_stamp)
+#              (sql/schema_clustered.sql), a lookup reads the primary key b-tree only
+hash_layout = "heap"
+schema_files = {
+    "heap": "sql/schema.sql",
+    "clustered": "sql/schema_clustered.sql",
+}
+
 def connect() -> tuple[sqlite3.Connection]:
     con = sqlite3.connect(library)
     return con
 
-def create_hash_index():
-    with connect() as con:
-        cur = con.cursor()
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_hash_val ON hashes(hash_val)")
-        con.commit()
+# read-only connections kept open per process by the ConnectionPool, see reader()
+max_reader_connections = 8
+# compiled statements kept per connection (sqlite3 reuses them when the same SQL runs again)
+cached_statements = 256
+
+class ConnectionPool:
+    """
+    connections to one database, kept open for the life of the process
+    (for the serving path: opening a connection costs more than a song lookup)
+
+    - up to `max_readers` read-only connections, each used by one thread at a time
+    - one writer connection, used by one thread at a time
+
+    ```
+    pool = ConnectionPool("sql/library.db")
+    with pool.reader() as con:
+        con.execute("SELECT ...")
+    with pool.writer() as con:
+        con.execute("INSERT ...")   # committed on exit, rolled back on an exception
+    ```
+
+    each connection caches its compiled statements, so queries that run on every request
+    are only prepared once. Bulk loads (`compute_source_hashes()`) and schema changes
+    keep using their own `connect()` connection
+    """
+
+    def __init__(self, database: str, max_readers: int = None):
+        self.database = database
+        self.pid = os.getpid()
+        self._idle_readers = []
+        self._reader_slots = threading.BoundedSemaphore(max_readers or max_reader_connections)
+        self._readers_lock = threading.Lock()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    def _open(self, read_only: bool) -> sqlite3.Connection:
+        # connections are handed between threads, never used by two at once
+        if read_only:
+            uri = f"{Path(self.database).resolve().as_uri()}?mode=ro"
+            return sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=cached_statements)
+        return sqlite3.connect(self.database, check_same_thread=False, cached_statements=cached_statements)
+
+    @contextlib.contextmanager
+    def reader(self):
+        """
+        borrows a read-only connection, waits if `max_readers` are in use
+        """
+        with self._reader_slots:
+            with self._readers_lock:
+                con = self._idle_readers.pop() if self._idle_readers else None
+            if con is None:
+                con = self._open(read_only=True)
+            try:
+                yield con
+            finally:
+                with self._readers_lock:
+                    self._idle_readers.append(con)
+
+    @contextlib.contextmanager
+    def writer(self):
+        """
+        borrows the writer connection, commits when the block exits without an exception
+        """
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._open(read_only=False)
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+
+    def close(self) -> None:
+        with self._readers_lock:
+            for con in self._idle_readers:
+                con.close()
+            self._idle_readers = []
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ConnectionPool:
+    """
+    the pool of this process for the current `library`, a new one after
+    `library` changes or in a forked child process
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.database != library or _pool.pid != os.getpid():
+            if _pool is not None and _pool.pid == os.getpid():
+                _pool.close()
+            _pool = ConnectionPool(library)
+        return _pool
+
+def close_pool() -> None:
+    """
+    closes the pooled connections, e.g. before the database file is replaced
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.close()
+        _pool = None
+
+def reader():
+    """
+    `with reader() as con:` a pooled read-only connection, see `ConnectionPool`
+    """
+    return get_pool().reader()
+
+def writer():
+    """
+    `with writer() as con:` the pooled writer connection, see `ConnectionPool`
+    """
+    return get_pool().writer()
+
+def get_hash_layout(con: sqlite3.Connection) -> str:
+    """
+    returns the layout (`"heap"` or `"clustered"`) of the hashes table in the database of `con`
+    """
+    cur = con.cursor()
+    cur.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'hashes'")
+    table_sql = cur.fetchone()[0]
+    return "clustered" if "WITHOUT ROWID" in table_sql.upper() else "heap"
+
+def create_hash_index(con: sqlite3.Connection = None):
+    """
+    indexes hashes by hash_val, the clustered layout is already ordered by hash_val
+    """
+    if con is None:
+        with connect() as con:
+            return create_hash_index(con)
+    if get_hash_layout(con) == "clustered":
+        return
+    cur = con.cursor()
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_hash_val ON hashes(hash_val)")
+    con.commit()
+
+def drop_hash_index(con: sqlite3.Connection = None):
+    """
+    inserting into an indexed table also updates the index for every row,
+    for large loads it is faster to drop the index and rebuild it afterwards
+    with `create_hash_index()`
+    """
+    if con is None:
+        with connect() as con:
+            return drop_hash_index(con)
+    cur = con.cursor()
+    cur.execute("DROP INDEX IF EXISTS idx_hash_val")
+    con.commit()
+
+def set_bulk_load_pragmas(con: sqlite3.Connection, cache_size_mb: int = 256):
+    """
+    tunes a connection for a large load of hashes:
+
+    - `journal_mode=WAL`: appends to a write-ahead log instead of copying pages to a rollback journal
+      (persists in the database file, readers are not blocked by the writer)
+    - `synchronous=NORMAL`: in WAL mode, only fsync at checkpoints instead of at every commit
+    - `cache_size`: keep more pages (of the table and index b-trees) in memory
+    - `temp_store=MEMORY`: sorting for `CREATE INDEX` happens in memory
+    """
+    cur = con.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    # negative values are in KiB
+    cur.execute(f"PRAGMA cache_size=-{cache_size_mb * 1024}")
+    cur.execute("PRAGMA temp_store=MEMORY")
 
 def add_song(track_info: dict) -> str:
     """
@@ -36,38 +222,50 @@ def add_song(track_info: dict) -> str:
     """
 
 
-    with connect() as con:
+    with writer() as con:
         cur = con.cursor()
-
-        audio_path = track_info["audio_path"]
-        duration_s = librosa.get_duration(path=audio_path)
-
-
-        try:
-            cur.execute("""
-                INSERT INTO songs 
-                        (youtube_url, title, artist, artwork_url, audio_path, duration_s)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                """, (
-                    track_info["youtube_url"],
-                    track_info["title"],
-                    track_info["artist"],
-                    track_info["artwork_url"],
-                    track_info["audio_path"],
-                    duration_s,
-                )
-            )
-            con.commit()
-        except sqlite3.IntegrityError:
+        song_id = insert_song(track_info, cur)
+        if song_id is None:
             cur.execute("""
             SELECT id FROM songs WHERE youtube_url = ?
                         """, (track_info["youtube_url"],))
             song_id = cur.fetchone()[0]
             return song_id
-        # sqlite:
-        cur.execute("SELECT last_insert_rowid()")
-        song_id = cur.fetchone()[0]
-        return song_id
+    # a reused id must not be answered from the metadata of a deleted song
+    invalidate_song_cache([song_id])
+    invalidate_catalog_caches()
+    return song_id
+
+
+def insert_song(track_info: dict, cur: sqlite3.Cursor) -> int|None:
+    """
+    inserts the songs row of `track_info` (see `add_song()`) with `cur`, the caller commits
+    and then calls `invalidate_song_cache([song_id])`
+
+    returns the new song id, `None` if a song with the same youtube_url exists
+    """
+    audio_path = track_info["audio_path"]
+    duration_s = librosa.get_duration(path=audio_path)
+
+    try:
+        cur.execute("""
+            INSERT INTO songs 
+                    (youtube_url, title, artist, artwork_url, audio_path, duration_s)
+                    VALUES (?, ?, ?, ?, ?, ?)
+            """, (
+                track_info["youtube_url"],
+                track_info["title"],
+                track_info["artist"],
+                track_info["artwork_url"],
+                track_info["audio_path"],
+                duration_s,
+            )
+        )
+    except sqlite3.IntegrityError:
+        return None
+    # sqlite:
+    cur.execute("SELECT last_insert_rowid()")
+    return cur.fetchone()[0]
 
 
 def add_songs(audio_directory: str = "./tracks", n_songs: int = None, specific_songs: list[str] = None) -> None:
@@ -87,27 +285,75 @@ def add_songs(audio_directory: str = "./tracks", n_songs: int = None, specific_s
         else:
             add_song(track_info)
 
+# metadata of the most recently used songs, kept in memory by retrieve_songs()
+song_cache_size = 1024
+_song_cache = OrderedDict()  # {(library, song_id): row}, least recently used first
+_song_cache_lock = threading.Lock()
+
+@metrics.stage("metadata")
+def retrieve_songs(song_ids) -> dict[int, dict]:
+    """
+    returns `{song_id: row}` for the songs in `song_ids` that exist, each row a dict
+    of the songs table columns (like `retrieve_song()`)
+
+    songs missing from the in-memory cache are fetched with one query,
+    the cache keeps the `song_cache_size` most recently used songs.
+    Call `invalidate_song_cache()` after changing the songs table
+    """
+    song_ids = list(dict.fromkeys(int(song_id) for song_id in song_ids))
+    songs = {}
+    with _song_cache_lock:
+        for song_id in song_ids:
+            row = _song_cache.get((library, song_id))
+            if row is not None:
+                _song_cache.move_to_end((library, song_id))
+                songs[song_id] = dict(row)
+    missing = [song_id for song_id in song_ids if song_id not in songs]
+
+    fetched = {}
+    with reader() as con:
+        cur = con.cursor()
+        for start in range(0, len(missing), lookup_chunk_size):
+            chunk = missing[start:start + lookup_chunk_size]
+            placeholders = ", ".join("?" * len(chunk))
+            cur.execute(f"SELECT * FROM songs WHERE id IN ({placeholders})", chunk)
+            columns = [column[0] for column in cur.description]
+            for row in cur.fetchall():
+                row = dict(zip(columns, row))
+                fetched[row["id"]] = row
+
+    with _song_cache_lock:
+        for song_id, row in fetched.items():
+            _song_cache[(library, song_id)] = row
+            songs[song_id] = dict(row)
+        while len(_song_cache) > song_cache_size:
+            _song_cache.popitem(last=False)
+    return songs
+
+def invalidate_song_cache(song_ids=None) -> None:
+    """
+    forgets the cached metadata of `song_ids` (every song when `None`)
+    """
+    with _song_cache_lock:
+        if song_ids is None:
+            _song_cache.clear()
+            return
+        for song_id in song_ids:
+            _song_cache.pop((library, int(song_id)), None)
+
 def retrieve_song(song_id) -> dict|None:
-    with connect() as con:
-        df = pd.read_sql_query("SELECT * FROM songs WHERE id = ?", con, params=(song_id,))
-        if df.empty:
-            return None
-        row = df.iloc[0].to_dict()
-        return row
+    return retrieve_songs([song_id]).get(int(song_id))
 
 def retrieve_song_id(youtube_url: str) -> int:
-    with connect() as con:
+    with reader() as con:
         cur = con.cursor()
         cur.execute("SELECT id FROM songs WHERE youtube_url = ?", (youtube_url,))
-        song_id = cur.fetchone()[0]
-        try:
-            return int(song_id)
-        except:
-            return None
+        row = cur.fetchone()
+        return None if row is None else int(row[0])
 
     
 def retrieve_song_ids() -> list[int]:
-    with connect() as con:
+    with reader() as con:
         cur = con.cursor()
         cur.execute("SELECT id FROM songs ORDER BY id ASC")
         ids = [row[0] for row in cur.fetchall()]
@@ -123,26 +369,98 @@ def add_hash(hash_val: int, time_stamp: float, song_id: int, cur: sqlite3.Cursor
     add_hash(hash_val, time_stamp, song_id, cur)
     ```
     """
-    cur.execute("""INSERT INTO hashes 
+    # OR IGNORE: the clustered layout stores each (hash_val, song_id, time_stamp) once
+    cur.execute("""INSERT OR IGNORE INTO hashes 
                     (hash_val, time_stamp, song_id) 
                     VALUES (?, ?, ?)""", 
                     (hash_val, time_stamp, song_id))
     
-def add_hashes(hashes: dict[int, tuple[int, int]]):
+def add_hashes(hashes: tuple[np.ndarray, np.ndarray], song_id: int,
+               con: sqlite3.Connection = None, executemany: bool = True, update_df: bool = True):
     """
-    uses a db cursor for efficiency 
-    (avoid creating new cursor repeatedly over many queries)
-    ```
-    con = DBcontrol.connect()
-    cur = con.cursor()
-    add_hash(hash_val, time_stamp, song_id, cur)
-    ```
+    inserts the fingerprints of one song
+
+    hashes: `(hash_vals, anchor_times)` arrays from `hasher.create_hashes()`
+
+    `con=None` (default) uses the pooled writer connection and commits,
+    otherwise the rows are inserted with `con` and the caller commits
+
+    `executemany=True` (default) inserts all rows of the song with a single `cur.executemany()`,
+    `executemany=False` calls `add_hash()` once per row
+
+    `update_df=True` (default) counts the song in the `hash_df` table,
+    `update_df=False` leaves it to a later `rebuild_hash_df()`
     """
-    with connect() as con:
-        cur = con.cursor()
-        for address, (anchorT, song_id) in hashes.items():
+    if con is None:
+        with writer() as con:
+            add_hashes(hashes, song_id, con, executemany, update_df)
+        return
+
+    hash_vals, anchor_times = hashes
+    cur = con.cursor()
+    if executemany:
+        cur.executemany("""INSERT OR IGNORE INTO hashes 
+                        (hash_val, time_stamp, song_id) 
+                        VALUES (?, ?, ?)""",
+                        zip(hash_vals.tolist(), anchor_times.tolist(), repeat(song_id)))
+    else:
+        for address, anchorT in zip(hash_vals.tolist(), anchor_times.tolist()):
             add_hash(address, anchorT, song_id, cur)
-        con.commit()
+    if update_df:
+        add_hash_df(hash_vals, cur)
+
+def add_hash_df(hash_vals: np.ndarray, cur: sqlite3.Cursor) -> None:
+    """
+    counts one more song containing each of `hash_vals` (the hash values of one song)
+    in the `hash_df` table
+    """
+    cur.executemany("""INSERT INTO hash_df (hash_val, n_songs) VALUES (?, 1)
+                    ON CONFLICT (hash_val) DO UPDATE SET n_songs = n_songs + 1""",
+                    zip(np.unique(hash_vals).tolist()))
+
+def recount_hash_df(hash_vals: np.ndarray, cur: sqlite3.Cursor) -> None:
+    """
+    recomputes the `hash_df` rows of `hash_vals` from the hashes table, for songs
+    fingerprinted again (whose hashes `add_hash_df()` would count a second time)
+
+    one join through the hash index, call it once the index exists (see `create_hash_index()`)
+    """
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS recount_hash_vals(hash_val INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM recount_hash_vals")
+    cur.executemany("INSERT INTO recount_hash_vals (hash_val) VALUES (?)", zip(np.unique(hash_vals).tolist()))
+    cur.execute("""INSERT OR REPLACE INTO hash_df (hash_val, n_songs)
+                   SELECT hashes.hash_val, COUNT(DISTINCT hashes.song_id)
+                   FROM recount_hash_vals CROSS JOIN hashes ON hashes.hash_val = recount_hash_vals.hash_val
+                   GROUP BY hashes.hash_val""")
+    cur.execute("DROP TABLE recount_hash_vals")
+
+def create_hash_df(con: sqlite3.Connection) -> None:
+    """
+    creates and fills the `hash_df` table if the database does not have one yet
+    """
+    cur = con.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hash_df'")
+    if cur.fetchone() is None:
+        rebuild_hash_df(con)
+
+def rebuild_hash_df(con: sqlite3.Connection = None) -> None:
+    """
+    recomputes the `hash_df` table from the hashes table,
+    creating it in databases made before the table existed
+    """
+    if con is None:
+        with connect() as con:
+            rebuild_hash_df(con)
+        con.close()
+        return
+    cur = con.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS hash_df(
+                    hash_val INTEGER PRIMARY KEY,
+                    n_songs INTEGER NOT NULL)""")
+    cur.execute("DELETE FROM hash_df")
+    cur.execute("""INSERT INTO hash_df (hash_val, n_songs)
+                   SELECT hash_val, COUNT(DISTINCT song_id) FROM hashes GROUP BY hash_val""")
+    con.commit()
 
 def retrieve_hashes(hash_val: int, cursor: sqlite3.Cursor) -> tuple[int, int, int]|None:
     """
@@ -157,61 +475,343 @@ def retrieve_hashes(hash_val: int, cursor: sqlite3.Cursor) -> tuple[int, int, in
     result = cursor.fetchall()
     return result
 
+# SQLite limits the number of bound parameters per statement
+# (SQLITE_MAX_VARIABLE_NUMBER, 999 on older builds)
+lookup_chunk_size = 900
+
+def retrieve_hashes_bulk(hash_vals, cursor: sqlite3.Cursor) -> dict[int, list[tuple[int, int]]]:
+    """
+    bulk version of `retrieve_hashes()`, looks up every hash value of a sample at once
+
+    Input: hash_vals: iterable of hash values we are searching for (duplicates are ignored)
+
+    Output: matches grouped by song:
+    ```
+    {song_id: [(hash_val, time_stamp), (hash_val, time_stamp), ...], ...}
+    ```
+
+    see `retrieve_postings()`
+    """
+    matches = defaultdict(list)
+    postings = retrieve_postings(hash_vals, cursor)
+    for hash_val, song_id, time_stamp in zip(*(a.tolist() for a in postings)):
+        matches[song_id].append((hash_val, time_stamp))
+    return dict(matches)
+
+def retrieve_postings(hash_vals, cursor: sqlite3.Cursor) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    returns parallel arrays `(hash_vals, song_ids, time_stamps)` of every row
+    matching one of `hash_vals` (an iterable of hash values, duplicates are ignored)
+
+    uses chunked `SELECT ... WHERE hash_val IN (?, ?, ...)` queries,
+    so a sample makes `len(hash_vals) / lookup_chunk_size` round-trips to the database
+    instead of one per hash
+    """
+    if not isinstance(hash_vals, np.ndarray):
+        hash_vals = np.array(list(hash_vals), dtype=np.int64)
+    hash_vals = np.unique(hash_vals).tolist()
+    rows = []
+    for start in range(0, len(hash_vals), lookup_chunk_size):
+        chunk = hash_vals[start:start + lookup_chunk_size]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(
+            f"SELECT hash_val, song_id, time_stamp FROM hashes WHERE hash_val IN ({placeholders})",
+            chunk
+        )
+        rows.extend(cursor.fetchall())
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 3)
+    return rows[:, 0].astype(np.uint32), rows[:, 1].astype(np.int32), rows[:, 2].astype(np.int32)
+
+def retrieve_hash_df(hash_vals, cursor: sqlite3.Cursor) -> tuple[np.ndarray, np.ndarray]:
+    """
+    returns `(hash_vals, n_songs)`: the distinct values of `hash_vals`, sorted, and the
+    number of songs containing each of them (0 when no song does), from the `hash_df` table
+    """
+    hash_vals = np.unique(np.asarray(hash_vals, dtype=np.int64))
+    n_songs = np.zeros(len(hash_vals), dtype=np.int64)
+    for start in range(0, len(hash_vals), lookup_chunk_size):
+        chunk = hash_vals[start:start + lookup_chunk_size].tolist()
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(f"SELECT hash_val, n_songs FROM hash_df WHERE hash_val IN ({placeholders})", chunk)
+        rows = np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+        n_songs[np.searchsorted(hash_vals, rows[:, 0])] = rows[:, 1]
+    return hash_vals.astype(np.uint32), n_songs
+
+def count_songs(cursor: sqlite3.Cursor) -> int:
+    cursor.execute("SELECT COUNT(*) FROM songs")
+    return cursor.fetchone()[0]
 
-def create_tables():
+
+def invalidate_catalog_caches() -> None:
+    """
+    forgets the query results cached by search.py, call after changing the songs in `library`
+    (the cache is keyed by the library path, a rebuilt database has the same one)
+    """
+    # search.py imports this module
+    from search import invalidate_result_cache
+    invalidate_result_cache()
+
+def create_tables(layout: str = None):
     """
     Creates necessary tables in the database
+
+    `layout=None` (default) uses the hashes table layout in `hash_layout`
     """
-    if os.path.exists(library):
-        os.remove(library)
+    if layout is None:
+        layout = hash_layout
+    # pooled connections would keep reading the deleted file
+    close_pool()
+    invalidate_song_cache()
+    invalidate_catalog_caches()
+    # also remove the write-ahead log of a previous database (see set_bulk_load_pragmas())
+    for path in (library, library + "-wal", library + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
     with sqlite3.connect(library) as con:
         cur = con.cursor()
-        with open("sql/schema.sql", "r") as f:
+        with open(schema_files[layout], "r") as f:
             schema_sql = f.read()
         cur.executescript(schema_sql)
         con.commit()
+
+def migrate_hash_layout(layout: str = "clustered") -> None:
+    """
+    converts the hashes table of an existing `library` database to `layout`
+    (`"clustered"` or `"heap"`), keeping every song and hash
+
+    ```
+    import DBcontrol
+    DBcontrol.library = "sql/library.db"
+    DBcontrol.migrate_hash_layout("clustered")
+    ```
+    """
+    # CREATE TABLE hashes(...) statement of the target layout
+    with open(schema_files[layout], "r") as f:
+        statements = f.read().split(";")
+    hashes_sql = next(
+        statement for statement in statements
+        if "CREATE TABLE hashes" in statement
+    ).split("CREATE TABLE hashes", 1)[1]
+
+    with connect() as con:
+        if get_hash_layout(con) == layout:
+            return
+        cur = con.cursor()
+        cur.execute("DROP INDEX IF EXISTS idx_hash_val")
+        cur.execute(f"CREATE TABLE hashes_migrated{hashes_sql}")
+        # inserting in primary key order appends to the end of the b-tree
+        cur.execute("""INSERT OR IGNORE INTO hashes_migrated (hash_val, time_stamp, song_id)
+                       SELECT hash_val, time_stamp, song_id FROM hashes
+                       ORDER BY hash_val, song_id, time_stamp""")
+        cur.execute("DROP TABLE hashes")
+        cur.execute("ALTER TABLE hashes_migrated RENAME TO hashes")
+        con.commit()
+        create_hash_index(con)
+        # give the pages of the old table back to the file system
+        con.execute("VACUUM")
+    con.close()
         
-def init_db(tracks_dir: str = None, n_songs: int = None, specific_songs: list[str] = None):
+def init_db(tracks_dir: str = None, n_songs: int = None, specific_songs: list[str] = None, n_workers: int = 1):
     """
     tracks_dir:
         Path to the audio dataset downloaded by `musicdl`. 
         Default is to look for a folder or zip archive matching the pattern "`tracks*`"
     n_songs:
         Take a sample from the top of the tracks dataset. Default is to read all songs
+    n_workers:
+        Number of processes fingerprinting songs, see `compute_source_hashes()`
 
     """
     create_tables()
     add_songs("./tracks", n_songs, specific_songs)
-    compute_source_hashes()
+    compute_source_hashes(n_workers=n_workers)
+
+# songs longer than this (seconds) are decoded and fingerprinted block by block
+# (see const_map.stream_constellation_map()), so memory use does not grow with their length
+chunked_min_duration_s = 600
+
+def fingerprint_song(song_id: int, audio_path: str, resample_rate: None|int = 11025) -> tuple[int, tuple[np.ndarray, np.ndarray]|None, str|None]:
+    """
+    decodes and fingerprints one song, block by block if it is longer than `chunked_min_duration_s`
+
+    returns `(song_id, hashes, error)`: `hashes` is `None` and `error` describes
+    the problem if the file could not be decoded or fingerprinted
+    """
+    try:
+        if librosa.get_duration(path=audio_path) > chunked_min_duration_s:
+            sr = audio_sampling_rate(audio_path, resample_rate)
+            peak_chunks = stream_constellation_map(read_audio_blocks(audio_path, resample_rate), sr)
+            hashes = stream_hashes(peak_chunks, sr)
+        else:
+            sr = audio_sampling_rate(audio_path, resample_rate)
+            constellation_map = constellation_map_from_file(audio_path, resample_rate)
+            hashes = create_hashes(constellation_map, sr)
+    except Exception as e:
+        return song_id, None, f"{type(e).__name__}: {e}"
+    return song_id, hashes, None
+
+def fingerprint_songs_parallel(songs: list[tuple[int, str]], resample_rate: None|int = 11025, n_workers: int = None):
+    """
+    songs: list of `(song_id, audio_path)`
+
+    fingerprints songs in `n_workers` processes (`None`: one per CPU core),
+    yields `fingerprint_song()` results in the order they finish.
+
+    At most `2 * n_workers` songs are in flight, so finished fingerprints
+    do not pile up in memory when the consumer is slower than the workers
+
+    When a worker process dies (e.g. killed for running out of memory), every song in
+    flight fails with it: they are yielded as failed (`error` is the `BrokenProcessPool`)
+    since the one that caused it is unknown, and the other songs go to new processes
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    songs = iter(songs)
+    pool = ProcessPoolExecutor(max_workers=n_workers)
+    # future -> song_id
+    in_flight = {}
+
+    def result(future) -> tuple:
+        try:
+            return future.result()
+        except BrokenProcessPool as e:
+            return in_flight[future], None, f"{type(e).__name__}: {e}"
+
+    try:
+        while True:
+            for song_id, audio_path in islice(songs, 2 * n_workers - len(in_flight)):
+                in_flight[pool.submit(fingerprint_song, song_id, audio_path, resample_rate)] = song_id
+            if not in_flight:
+                break
 
-def compute_source_hashes(song_ids: list[int] = None, resample_rate: None|int = 11025):
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                # every future of the pool fails (or finished before), the results
+                # of the songs in flight are ready
+                done = list(in_flight)
+                pool.shutdown(wait=False)
+                pool = ProcessPoolExecutor(max_workers=n_workers)
+            for future in done:
+                yield result(future)
+                del in_flight[future]
+    finally:
+        pool.shutdown()
+
+# insert_mode options of compute_source_hashes()
+insert_modes = ("row", "executemany", "bulk")
+
+def compute_source_hashes(song_ids: list[int] = None, resample_rate: None|int = 11025,
+                          insert_mode: str = "bulk", rebuild_index: bool = False,
+                          n_workers: int = 1) -> dict:
     """
     `song_ids=None` (default) use all song_ids from database
 
     `resample_rate=None` to use original sampling rate from file
 
     Assumes all songs are the same sampling rate
+
+    `insert_mode`:
+    - `"row"`: one `INSERT` per hash
+    - `"executemany"`: one `executemany()` per song
+    - `"bulk"` (default): `executemany()` on a connection tuned with `set_bulk_load_pragmas()`
+
+    `rebuild_index=True` drops the hash index before loading and rebuilds it afterwards,
+    and recomputes the `hash_df` table once at the end instead of updating it per song
+    (faster when adding many hashes to a database that already has an index)
+
+    `n_workers`: number of processes decoding and fingerprinting songs in parallel
+    (`None`: one per CPU core). This process is the only one writing to the database,
+    committing each song as its fingerprints arrive.
+
+    Songs that fail to decode or fingerprint are skipped and reported in `"failed"`
+
+    returns throughput statistics:
+    ```
+    {"songs": ..., "hashes": ..., "seconds": ..., "insert_seconds": ...,
+     "songs_per_s": ..., "hashes_per_s": ..., "failed": [(song_id, error), ...]}
+    ```
     """
+    if insert_mode not in insert_modes:
+        raise ValueError(f"insert_mode must be one of {insert_modes}, got {insert_mode!r}")
+
     if song_ids is None:
         song_ids = retrieve_song_ids()
-    
-    for song_id in song_ids:
-        print(f"{song_id:03} ================================================")
-        song = retrieve_song(song_id)
-        print(f"{song['title']} by {song['artist']}")
-        #duration_s = song["duration_s"]
-        audio_path = song["audio_path"]
-
-        #waveform = song["waveform"]
-        #audio_path = "temp_audio.mp3"
-        #with open(audio_path, 'wb') as f:
-            #f.write(waveform)
-        #print(audio_path)
-
-        audio, sr = preprocess_audio(audio_path, sr=resample_rate)
-        constellation_map = create_constellation_map(audio, sr)
-        hashes = create_hashes(constellation_map, song_id, sr)
-        add_hashes(hashes)
-    
-    create_hash_index()
-    return
+    songs = retrieve_songs(song_ids)
+
+    #waveform = song["waveform"]
+    #audio_path = "temp_audio.mp3"
+    #with open(audio_path, 'wb') as f:
+        #f.write(waveform)
+    #print(audio_path)
+    audio_paths = [(song_id, song["audio_path"]) for song_id, song in songs.items()]
+    if n_workers == 1:
+        fingerprints = (fingerprint_song(song_id, audio_path, resample_rate) for song_id, audio_path in audio_paths)
+    else:
+        fingerprints = fingerprint_songs_parallel(audio_paths, resample_rate, n_workers)
+
+    start = time.perf_counter()
+    insert_seconds = 0
+    n_songs = 0
+    n_hashes = 0
+    failed = []
+    with connect() as con:
+        if insert_mode == "bulk":
+            set_bulk_load_pragmas(con)
+        if rebuild_index:
+            drop_hash_index(con)
+        create_hash_df(con)
+        # songs fingerprinted before are already counted in hash_df, their rows are
+        # recounted once the hash index exists instead of incremented per song
+        # (one scan of the table as it is before loading)
+        refingerprinted = set()
+        if not rebuild_index:
+            refingerprinted = {row[0] for row in con.execute("SELECT DISTINCT song_id FROM hashes")}
+            refingerprinted &= songs.keys()
+        recount_hash_vals = []
+
+        for song_id, hashes, error in fingerprints:
+            song = songs[song_id]
+            print(f"{song_id:03} ================================================")
+            print(f"{song['title']} by {song['artist']}")
+            if error is not None:
+                print(f"skipping {song['audio_path']}: {error}")
+                failed.append((song_id, error))
+                continue
+
+            insert_start = time.perf_counter()
+            update_df = not rebuild_index and song_id not in refingerprinted
+            add_hashes(hashes, song_id, con, executemany=(insert_mode != "row"), update_df=update_df)
+            if song_id in refingerprinted:
+                recount_hash_vals.append(hashes[0])
+            con.commit()
+            insert_seconds += time.perf_counter() - insert_start
+            n_songs += 1
+            n_hashes += len(hashes[0])
+
+        insert_start = time.perf_counter()
+        create_hash_index(con)
+        if rebuild_index:
+            rebuild_hash_df(con)
+        elif recount_hash_vals:
+            recount_hash_df(np.concatenate(recount_hash_vals), con.cursor())
+            con.commit()
+        insert_seconds += time.perf_counter() - insert_start
+    con.close()
+    invalidate_catalog_caches()
+
+    seconds = time.perf_counter() - start
+    stats = {
+        "songs": n_songs,
+        "hashes": n_hashes,
+        "seconds": seconds,
+        "insert_seconds": insert_seconds,
+        "songs_per_s": n_songs / seconds if seconds else 0.0,
+        "hashes_per_s": n_hashes / seconds if seconds else 0.0,
+        "failed": failed,
+    }
+    print(f"added {stats['songs']} songs, {stats['hashes']} hashes in {seconds:.2f} s "
+          f"({stats['songs_per_s']:.2f} songs/s, {stats['hashes_per_s']:.0f} hashes/s, "
+          f"{insert_seconds:.2f} s inserting)")
+    if failed:
+        print(f"failed to fingerprint {len(failed)} songs: {[song_id for song_id, _ in failed]}")
+    return stats
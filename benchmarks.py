@@ -0,0 +1,752 @@
+import io
+import os
+import sys
+import time
+import tempfile
+import itertools
+import contextlib
+import tracemalloc
+
+import numpy as np
+
+from cm_helper import preprocess_audio
+from const_map import create_constellation_map
+from hasher import create_hashes, create_address
+
+# usage:
+#   python benchmarks.py                       run every benchmark
+#   python benchmarks.py fingerprint_formats   run a single benchmark
+#
+# most benchmarks default to the files in audio_samples/,
+# pass audio paths after the benchmark name to use other files
+
+sample_audio_paths = [
+    "audio_samples/sample.wav",
+    "audio_samples/pb_recording_short.wav",
+    "audio_samples/Dogtooth_rec.flac",
+]
+
+
+def load_inputs(audio_paths: list[str] = None, track_length_s: int = 240) -> list[tuple[str, np.ndarray, int]]:
+    """
+    returns a list of `(name, audio, sr)`
+
+    `audio_paths=None` (default) uses the files in `sample_audio_paths`, plus the
+    samples repeated into a `track_length_s` second input the length of a catalog track
+    """
+    inputs = []
+    for audio_path in audio_paths or sample_audio_paths:
+        audio, sr = preprocess_audio(audio_path)
+        inputs.append((audio_path, audio, sr))
+    if not audio_paths:
+        samples = np.concatenate([audio for _, audio, _ in inputs])
+        n_repeats = int(np.ceil(track_length_s * sr / len(samples)))
+        inputs.append((f"{track_length_s} s track", np.tile(samples, n_repeats)[:track_length_s * sr], sr))
+    return inputs
+
+
+def time_call(fn, *args, repeat: int = 5):
+    """
+    returns `(result, seconds)`, seconds is the best of `repeat` calls
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def allocated_bytes(fn, *args) -> int:
+    """
+    returns the number of bytes allocated by `fn(*args)` that are still held by its result
+    """
+    tracemalloc.start()
+    result = fn(*args)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def peak_allocated_bytes(fn, *args) -> int:
+    """
+    returns the largest number of bytes held at once while `fn(*args)` runs
+    """
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+#
+# fingerprint container: (hash_vals, anchor_times) arrays vs {address: (anchorT, song_id)} dict
+#
+
+def fingerprints_as_dict(peaks: list[tuple[int, float]], sr, song_id=1) -> dict[int, tuple[int, int]]:
+    """
+    the `{address: (anchorT, song_id)}` dictionary `hasher.create_hashes()` used to build,
+    pairing a list of `(time, frequency)` peaks in nested loops (repeated addresses
+    overwrite each other)
+    """
+    fingerprints = {}
+    from parameters import read_parameters
+    fanout_t, fanout_f = read_parameters("hashing")
+
+    for i, anchor in enumerate(peaks):
+        for j in range(i+1, len(peaks)):
+            target = peaks[j]
+            time_diff = target[0] - anchor[0]
+            freq_diff = target[1] - anchor[1]
+
+            if time_diff <= 1:
+                continue
+            if np.abs(freq_diff) >= fanout_f:
+                continue
+            if time_diff > fanout_t:
+                break
+
+            address = create_address(anchor, target, sr)
+            anchorT = anchor[0]
+            fingerprints[address] = (int(anchorT), song_id)
+
+    return fingerprints
+
+
+def benchmark_fingerprint_formats(audio_paths: list[str] = None):
+    """
+    memory and time to build the fingerprints of each file, and how many
+    (hash, time) occurrences the dictionary form loses
+    """
+    for name, audio, sr in load_inputs(audio_paths):
+        constellation_map = create_constellation_map(audio, sr)
+        # the list of peaks the dictionary hasher took
+        peaks = list(zip(*(values.tolist() for values in constellation_map)))
+
+        hashes, array_seconds = time_call(create_hashes, constellation_map, sr)
+        fingerprints, dict_seconds = time_call(fingerprints_as_dict, peaks, sr)
+        array_bytes = allocated_bytes(create_hashes, constellation_map, sr)
+        dict_bytes = allocated_bytes(fingerprints_as_dict, peaks, sr)
+
+        n_occurrences = len(hashes[0])
+        print(f"{name}: {len(audio) / sr:.1f} s of audio, {n_occurrences} (hash, time) occurrences")
+        print(f"  arrays: {array_seconds * 1e3:8.2f} ms  {array_bytes / 1024:9.1f} KiB")
+        print(f"  dict:   {dict_seconds * 1e3:8.2f} ms  {dict_bytes / 1024:9.1f} KiB"
+              f"  ({n_occurrences - len(fingerprints)} occurrences lost)")
+
+
+#
+# ingestion: DBcontrol.compute_source_hashes() insert modes
+#
+
+@contextlib.contextmanager
+def temporary_library(audio_paths: list[str] = None, n_songs: int = 8, distinct: bool = False,
+                      hum_weight: float = 0.0):
+    """
+    points `DBcontrol.library` at a temporary database containing `n_songs` songs
+    (copies of the `load_inputs()` track), restored on exit. The audio cache is disabled meanwhile
+
+    `distinct=True` plays song `i` 3*i % faster, so that only song 0 matches
+    excerpts of the track instead of every song matching equally
+
+    `hum_weight` mixes the same steady hum into every song (`distinct=True` only),
+    giving hashes that occur in every song, like hum or a shared drum loop in a real catalog
+    """
+    import soundfile as sf
+    import DBcontrol
+    import cache
+
+    original_library, original_cache_dir = DBcontrol.library, cache.cache_dir
+    # ingestion benchmarks decode every song each time, not read it from the audio cache
+    cache.cache_dir = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        name, audio, sr = load_inputs(audio_paths)[-1]
+        audio_path = os.path.join(tmp_dir, "track.wav")
+        sf.write(audio_path, audio, sr)
+
+        DBcontrol.library = os.path.join(tmp_dir, "library.db")
+        try:
+            DBcontrol.create_tables()
+            for i in range(n_songs):
+                if distinct:
+                    audio_path = os.path.join(tmp_dir, f"track_{i}.wav")
+                    sample_positions = np.arange(0, len(audio) - 1, 1 + 0.03 * i)
+                    song_audio = np.interp(sample_positions, np.arange(len(audio)), audio)
+                    t = np.arange(len(song_audio)) / sr
+                    hum = np.sin(2 * np.pi * 60 * t) + 0.5 * np.sin(2 * np.pi * 120 * t) + 0.3 * np.sin(2 * np.pi * 1000 * t)
+                    sf.write(audio_path, song_audio + hum_weight * np.abs(audio).max() * hum, sr)
+                DBcontrol.add_song({
+                    "youtube_url": f"benchmark_{i}",
+                    "title": f"{name} ({i})",
+                    "artist": "benchmark",
+                    "artwork_url": "",
+                    "audio_path": audio_path,
+                })
+            yield DBcontrol
+        finally:
+            DBcontrol.library, cache.cache_dir = original_library, original_cache_dir
+
+
+def benchmark_ingestion(audio_paths: list[str] = None):
+    """
+    songs/s and hashes/s of `compute_source_hashes()` for each insert mode.
+    The hash index exists before loading, as when adding songs to an existing library
+    """
+    with temporary_library(audio_paths) as DBcontrol:
+        for insert_mode in DBcontrol.insert_modes:
+            for rebuild_index in (False, True):
+                with DBcontrol.connect() as con:
+                    con.execute("DELETE FROM hashes")
+                    con.execute("DELETE FROM hash_df")
+                DBcontrol.create_hash_index()
+
+                with contextlib.redirect_stdout(io.StringIO()):
+                    stats = DBcontrol.compute_source_hashes(insert_mode=insert_mode, rebuild_index=rebuild_index)
+                print(f"{insert_mode:>12}, rebuild_index={str(rebuild_index):<5}: "
+                      f"{stats['songs_per_s']:6.2f} songs/s  {stats['hashes_per_s']:9.0f} hashes/s  "
+                      f"({stats['hashes'] / stats['insert_seconds']:9.0f} hashes/s inserting)")
+
+
+def benchmark_parallel_ingestion(audio_paths: list[str] = None):
+    """
+    songs/s of `compute_source_hashes()` with a growing number of fingerprinting processes.
+    One song points at a file that does not exist, which is skipped
+    """
+    with temporary_library(audio_paths, n_songs=16) as DBcontrol:
+        with DBcontrol.connect() as con:
+            con.execute(
+                "INSERT INTO songs (youtube_url, title, artist, artwork_url, audio_path, duration_s) "
+                "VALUES ('benchmark_missing', 'missing file', 'benchmark', '', 'does_not_exist.wav', 0)"
+            )
+        for n_workers in sorted({1, 2, 4, os.cpu_count()}):
+            with DBcontrol.connect() as con:
+                con.execute("DELETE FROM hashes")
+                con.execute("DELETE FROM hash_df")
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                stats = DBcontrol.compute_source_hashes(n_workers=n_workers)
+            print(f"n_workers={n_workers:<3}: {stats['songs_per_s']:6.2f} songs/s  "
+                  f"{stats['hashes_per_s']:9.0f} hashes/s  ({len(stats['failed'])} failed)")
+
+
+#
+# hashes table layouts: heap + index on hash_val vs clustered (WITHOUT ROWID)
+#
+
+def sample_queries(audio_paths: list[str] = None, n_queries: int = 20, sample_s: int = 10,
+                   noise_weight: float = 0.3) -> list[tuple[np.ndarray, np.ndarray]]:
+    """
+    fingerprints of `n_queries` noisy `sample_s` second excerpts of the `load_inputs()` track
+    """
+    from cm_helper import add_noise
+
+    _, audio, sr = load_inputs(audio_paths)[-1]
+    rng = np.random.default_rng(1)
+    queries = []
+    for start in rng.integers(0, len(audio) - sample_s * sr, size=n_queries):
+        sample = add_noise(audio[start:start + sample_s * sr], noise_weight=noise_weight)
+        queries.append(create_hashes(create_constellation_map(sample, sr), sr))
+    return queries
+
+
+def benchmark_hash_layouts(audio_paths: list[str] = None):
+    """
+    time to look up the hashes of sample queries in each hashes table layout,
+    migrating the same library from one layout to the other
+    """
+    queries = sample_queries(audio_paths)
+    with temporary_library(audio_paths, n_songs=32) as DBcontrol:
+        with contextlib.redirect_stdout(io.StringIO()):
+            DBcontrol.compute_source_hashes()
+
+        for layout in ("heap", "clustered"):
+            DBcontrol.migrate_hash_layout(layout)
+            con = DBcontrol.connect()
+            cur = con.cursor()
+            cur.execute("EXPLAIN QUERY PLAN SELECT hash_val, time_stamp, song_id FROM hashes WHERE hash_val = ?", (0,))
+            plan = cur.fetchone()[-1]
+
+            def lookup_all():
+                return [DBcontrol.retrieve_hashes_bulk(hash_vals, cur) for hash_vals, _ in queries]
+            _, seconds = time_call(lookup_all)
+            con.close()
+
+            size_mb = os.path.getsize(DBcontrol.library) / 2**20
+            print(f"{layout:>9}: {seconds / len(queries) * 1e3:7.2f} ms per query  "
+                  f"{size_mb:7.1f} MiB  ({plan})")
+
+
+#
+# in-memory index vs SQLite lookups
+#
+
+def benchmark_memory_index(audio_paths: list[str] = None):
+    """
+    load time and size of `fingerprint_index.MemoryIndex`, and time to look up
+    the hashes of sample queries in it compared to SQLite
+    """
+    from fingerprint_index import MemoryIndex
+
+    queries = sample_queries(audio_paths)
+    with temporary_library(audio_paths, n_songs=32) as DBcontrol:
+        with contextlib.redirect_stdout(io.StringIO()):
+            DBcontrol.compute_source_hashes()
+
+        index, load_seconds = time_call(MemoryIndex.from_database, repeat=1)
+        print(f"loaded {len(index)} hashes in {load_seconds:.2f} s, {index.nbytes / 2**20:.1f} MiB")
+
+        con = DBcontrol.connect()
+        cur = con.cursor()
+        lookups = {
+            "sqlite": lambda hash_vals: DBcontrol.retrieve_postings(hash_vals, cur),
+            "memory": index.lookup,
+        }
+        for name, lookup in lookups.items():
+            _, seconds = time_call(lambda: [lookup(hash_vals) for hash_vals, _ in queries])
+            print(f"{name:>7}: {seconds / len(queries) * 1e3:7.3f} ms per query")
+        con.close()
+
+        _, add_seconds = time_call(index.add, 0, queries[0], repeat=1)
+        print(f"add(): {add_seconds * 1e3:.2f} ms for {len(queries[0][0])} hashes")
+
+
+def benchmark_mmap_index(audio_paths: list[str] = None):
+    """
+    export time and size of the `fingerprint_index.MmapIndex` files, and time to open
+    and query them compared to loading and querying `MemoryIndex`
+    """
+    from fingerprint_index import MemoryIndex, MmapIndex, export_mmap_index
+
+    queries = sample_queries(audio_paths)
+    with temporary_library(audio_paths, n_songs=32) as DBcontrol:
+        with contextlib.redirect_stdout(io.StringIO()):
+            DBcontrol.compute_source_hashes()
+        index_dir = os.path.join(os.path.dirname(DBcontrol.library), "fingerprint_index")
+
+        _, export_seconds = time_call(export_mmap_index, index_dir, repeat=1)
+        indexes = {
+            "memory": time_call(MemoryIndex.from_database, repeat=1),
+            "mmap": time_call(MmapIndex, index_dir, repeat=1),
+        }
+        print(f"exported in {export_seconds:.2f} s, {indexes['mmap'][0].nbytes / 2**20:.1f} MiB on disk")
+        for name, (index, open_seconds) in indexes.items():
+            _, seconds = time_call(lambda: [index.lookup(hash_vals) for hash_vals, _ in queries])
+            print(f"{name:>7}: opened in {open_seconds * 1e3:8.2f} ms  "
+                  f"{seconds / len(queries) * 1e3:7.3f} ms per query")
+
+
+#
+# progressive (early-terminating) scoring vs matching every hash
+#
+
+def benchmark_progressive_search(audio_paths: list[str] = None):
+    """
+    time to score sample queries with `search.score_hashes()` and
+    `search.score_hashes_progressive()`, and how often they agree on the top song
+    """
+    import search
+    from fingerprint_index import MemoryIndex
+
+    queries = {
+        "clean": sample_queries(audio_paths, noise_weight=0.05),
+        "noisy": sample_queries(audio_paths, noise_weight=0.5),
+    }
+    with temporary_library(audio_paths, n_songs=32, distinct=True) as DBcontrol:
+        with contextlib.redirect_stdout(io.StringIO()):
+            DBcontrol.compute_source_hashes()
+        indexes = {"sqlite": None, "memory": MemoryIndex.from_database()}
+
+        for (index_name, index), (query_name, query_hashes) in itertools.product(indexes.items(), queries.items()):
+            top_songs = {}
+            for name, score in (("full", search.score_hashes), ("progressive", search.score_hashes_progressive)):
+                results, seconds = time_call(lambda: [score(hashes, index)[0] for hashes in query_hashes])
+                top_songs[name] = [scores[0][0] if scores else None for scores in results]
+                print(f"{index_name:>6} {query_name} {name:>12}: {seconds / len(query_hashes) * 1e3:7.2f} ms per query")
+            n_agree = sum(full == progressive for full, progressive in zip(top_songs["full"], top_songs["progressive"]))
+            print(f"same top song for {n_agree}/{len(query_hashes)} queries")
+
+
+#
+# hash document-frequency stop-listing / IDF weights
+#
+
+def benchmark_hash_df(audio_paths: list[str] = None):
+    """
+    latency and accuracy of `search.score_hashes()` with common hashes skipped (`max_df`)
+    or down-weighted (`idf`), on samples made like `grid_search.augment_samples()`
+    (20 five second excerpts with noise_weight=0.3) of song 1, in a library where every song has the same hum
+    """
+    import search
+    from cm_helper import create_samples, add_noise
+    from fingerprint_index import MemoryIndex
+
+    with temporary_library(audio_paths, n_songs=32, distinct=True, hum_weight=0.1) as DBcontrol:
+        with contextlib.redirect_stdout(io.StringIO()):
+            DBcontrol.compute_source_hashes()
+        con = DBcontrol.connect()
+        df = np.array(con.execute("SELECT n_songs FROM hash_df").fetchall()).ravel()
+        con.close()
+        print(f"{len(df)} distinct hashes, document frequency: median {np.median(df):.0f}, "
+              f"99th percentile {np.percentile(df, 99):.0f}, max {df.max()}")
+
+        sr = 11025
+        queries = [
+            create_hashes(create_constellation_map(add_noise(sample, 0.3), sr), sr)
+            for sample in create_samples(DBcontrol.retrieve_song(1)["audio_path"], sr, n_samples=20)
+        ]
+        indexes = {"sqlite": None, "memory": MemoryIndex.from_database()}
+        options = [{"max_df": None, "idf": False}, {"max_df": None, "idf": True}]
+        options += [{"max_df": max_df, "idf": False} for max_df in (16, 8, 4, 2)]
+        for (index_name, index), kwargs in itertools.product(indexes.items(), options):
+            results, seconds = time_call(lambda: [search.score_hashes(hashes, index, **kwargs)[0] for hashes in queries])
+            n_correct = sum(bool(scores) and scores[0][0] == 1 for scores in results)
+            print(f"{index_name:>6} max_df={str(kwargs['max_df']):>4} idf={str(kwargs['idf']):<5}: "
+                  f"{seconds / len(queries) * 1e3:7.2f} ms per query  {n_correct}/{len(queries)} correct")
+
+
+#
+# streaming recognition: how much audio is needed before a match is reported
+#
+
+def benchmark_streaming(audio_paths: list[str] = None, n_queries: int = 20, chunk_s: float = 0.25):
+    """
+    seconds of audio `streaming.StreamingRecognizer` needs before it reports a match,
+    for noisy 10 second excerpts of song 0 pushed `chunk_s` seconds at a time,
+    and how often the reported song is the one `search.score_hashes()` picks from the whole excerpt
+    """
+    import search
+    from cm_helper import add_noise
+    from fingerprint_index import MemoryIndex
+    from streaming import StreamingRecognizer
+
+    _, audio, sr = load_inputs(audio_paths)[-1]
+    rng = np.random.default_rng(1)
+    samples = [
+        add_noise(audio[start:start + 10 * sr], noise_weight=0.3).astype(np.float32)
+        for start in rng.integers(0, len(audio) - 10 * sr, size=n_queries)
+    ]
+    with temporary_library(audio_paths, n_songs=32, distinct=True) as DBcontrol:
+        with contextlib.redirect_stdout(io.StringIO()):
+            DBcontrol.compute_source_hashes()
+        indexes = {"sqlite": None, "memory": MemoryIndex.from_database()}
+
+        for index_name, index in indexes.items():
+            seconds_needed, n_agree, n_matched = [], 0, 0
+            start_time = time.perf_counter()
+            for sample in samples:
+                recognizer = StreamingRecognizer(sr=sr, input_sr=sr, index=index)
+                for start in range(0, len(sample), int(chunk_s * sr)):
+                    if recognizer.push(sample[start:start + int(chunk_s * sr)]) is not None:
+                        break
+                recognizer.finish()
+                full = search.score_hashes(create_hashes(create_constellation_map(sample, sr), sr), index)[0]
+                if recognizer.match is not None:
+                    n_matched += 1
+                    seconds_needed.append(recognizer.seconds)
+                    n_agree += bool(full) and full[0][0] == recognizer.match[0]
+            seconds = time.perf_counter() - start_time
+            print(f"{index_name:>6}: matched {n_matched}/{len(samples)} after "
+                  f"{np.median(seconds_needed) if seconds_needed else float('nan'):.2f} s of audio (median), "
+                  f"same top song as the whole excerpt for {n_agree}/{n_matched}  "
+                  f"({seconds / len(samples) * 1e3:.1f} ms per query incl. full scoring)")
+
+
+#
+# chunked fingerprinting of long recordings vs decoding the whole file
+#
+
+def benchmark_chunked_fingerprinting(audio_paths: list[str] = None, lengths_min: tuple[int] = (4, 16, 64)):
+    """
+    peak memory and time to find the peaks of long recordings (the first file of
+    `audio_paths` repeated at its original sampling rate) with `create_constellation_map()`
+    of the whole decoded audio and with `stream_constellation_map()` of `read_audio_blocks()`
+    """
+    import soundfile as sf
+    from cm_helper import read_audio_blocks
+    from const_map import stream_constellation_map
+
+    def in_memory(audio_path):
+        audio, sr = preprocess_audio(audio_path, use_cache=False)
+        return len(create_constellation_map(audio, sr)[0])
+
+    def chunked(audio_path):
+        return sum(len(peak_times) for peak_times, _ in stream_constellation_map(read_audio_blocks(audio_path), 11025))
+
+    audio, sr = sf.read((audio_paths or sample_audio_paths)[0], dtype="float32")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for length_min in lengths_min:
+            audio_path = os.path.join(tmp_dir, f"{length_min}_min.wav")
+            n_samples = length_min * 60 * sr
+            with sf.SoundFile(audio_path, "w", sr, channels=audio.ndim, subtype="PCM_16") as f:
+                for _ in range(int(np.ceil(n_samples / len(audio)))):
+                    f.write(audio[:n_samples - f.frames])
+            for name, fn in (("in-memory", in_memory), ("chunked", chunked)):
+                n_peaks, seconds = time_call(fn, audio_path, repeat=1)
+                peak_bytes = peak_allocated_bytes(fn, audio_path)
+                print(f"{length_min:3d} min {name:>9}: {seconds:6.2f} s  peak {peak_bytes / 2**20:8.1f} MiB  ({n_peaks} peaks)")
+
+
+#
+# decoded audio cache: decoding and resampling each file vs memory-mapping the cached array
+#
+
+def benchmark_audio_cache(audio_paths: list[str] = None):
+    """
+    time of `preprocess_audio()` and `create_samples()` without the cache,
+    on a cache miss (decode and store) and on a cache hit, for each file
+    """
+    import cache
+    from cm_helper import create_samples
+
+    original_cache_dir = cache.cache_dir
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache.cache_dir = tmp_dir
+        try:
+            for audio_path in audio_paths or sample_audio_paths:
+                _, uncached_seconds = time_call(lambda: preprocess_audio(audio_path, use_cache=False))
+                _, miss_seconds = time_call(lambda: (cache.clear_cache(), preprocess_audio(audio_path)))
+                _, hit_seconds = time_call(lambda: preprocess_audio(audio_path))
+                _, samples_seconds = time_call(lambda: create_samples(audio_path, 11025, n_samples=20, n_seconds=1))
+                print(f"{audio_path}: uncached {uncached_seconds * 1e3:7.2f} ms  miss {miss_seconds * 1e3:7.2f} ms  "
+                      f"hit {hit_seconds * 1e3:6.3f} ms  create_samples (hit) {samples_seconds * 1e3:6.3f} ms")
+        finally:
+            cache.cache_dir = original_cache_dir
+
+
+#
+# grid search: fingerprinting every song for each parameter combination, with and without
+# the spectrogram / peak layers of const_map.constellation_map_from_file()
+#
+
+def benchmark_grid_cache(audio_paths: list[str] = None, n_songs: int = 8):
+    """
+    time to fingerprint `n_songs` songs (the `load_inputs()` track at different speeds)
+    for every combination of a small `cm_window_size` x `candidates_per_band` grid,
+    swept twice, with the cache disabled and enabled (starting empty)
+    """
+    import soundfile as sf
+    import cache
+    import parameters
+    from DBcontrol import fingerprint_song
+
+    original_cache_dir, original_parameters_json = cache.cache_dir, parameters.parameters_json
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        _, audio, sr = load_inputs(audio_paths)[-1]
+        song_paths = []
+        for i in range(n_songs):
+            song_paths.append(os.path.join(tmp_dir, f"track_{i}.wav"))
+            sample_positions = np.arange(0, len(audio) - 1, 1 + 0.03 * i)
+            sf.write(song_paths[-1], np.interp(sample_positions, np.arange(len(audio)), audio), sr)
+
+        parameters.parameters_json = os.path.join(tmp_dir, "parameters.json")
+        grid = list(itertools.product([4, 5, 10], [5, 7])) * 2
+        try:
+            for name, cache_dir in (("no cache", None), ("cache", os.path.join(tmp_dir, "cache"))):
+                cache.cache_dir = cache_dir
+                start = time.perf_counter()
+                for cm_window_size, candidates_per_band in grid:
+                    parameters.set_parameters(cm_window_size=cm_window_size, candidates_per_band=candidates_per_band)
+                    for song_id, song_path in enumerate(song_paths):
+                        fingerprint_song(song_id, song_path)
+                seconds = time.perf_counter() - start
+                print(f"{name:>8}: {len(grid)} combinations x {n_songs} songs in {seconds:6.2f} s")
+        finally:
+            cache.cache_dir, parameters.parameters_json = original_cache_dir, original_parameters_json
+
+
+#
+# /predict upload decoding: temporary file + ffmpeg + librosa.load vs decoding from memory
+#
+
+def benchmark_upload_decoding(audio_paths: list[str] = None):
+    """
+    per-stage time to turn an uploaded file into 11025 Hz samples, the way /predict used to
+    (write the upload to disk, ffmpeg to a 44.1 kHz wav, `preprocess_audio()` of that file)
+    and with `decode_audio_bytes()` from memory, then the remaining recognition stages
+
+    the ffmpeg stage is skipped (and the upload read directly) when ffmpeg is not installed
+    """
+    import shutil
+    import subprocess
+    import search
+    from cm_helper import decode_audio_bytes
+
+    has_ffmpeg = shutil.which("ffmpeg") is not None
+    if not has_ffmpeg:
+        print("ffmpeg not found: the file path skips the ffmpeg conversion")
+    for audio_path in audio_paths or sample_audio_paths:
+        with open(audio_path, "rb") as f:
+            data = f.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            upload_path = os.path.join(tmp_dir, "upload" + os.path.splitext(audio_path)[1])
+            wav_path = os.path.join(tmp_dir, "sample.wav") if has_ffmpeg else upload_path
+
+            def write_upload():
+                with open(upload_path, "wb") as f:
+                    f.write(data)
+
+            def convert():
+                if has_ffmpeg:
+                    subprocess.run(["ffmpeg", "-i", upload_path, "-ar", "44100", "-ac", "1", "-y", wav_path],
+                                   check=True, capture_output=True)
+
+            stages = {}
+            _, stages["write upload"] = time_call(write_upload)
+            _, stages["ffmpeg to wav"] = time_call(convert)
+            (file_audio, sr), stages["load + resample"] = time_call(lambda: preprocess_audio(wav_path, use_cache=False))
+            (memory_audio, sr), memory_seconds = time_call(decode_audio_bytes, data)
+
+        file_seconds = sum(stages.values())
+        constellation_map, peaks_seconds = time_call(create_constellation_map, memory_audio, sr)
+        hashes, hashes_seconds = time_call(create_hashes, constellation_map, sr)
+        print(f"{audio_path}: " + "  ".join(f"{name} {seconds * 1e3:.2f} ms" for name, seconds in stages.items()))
+        print(f"  file path {file_seconds * 1e3:7.2f} ms  in-memory decode {memory_seconds * 1e3:7.2f} ms  "
+              f"(then constellation map {peaks_seconds * 1e3:.2f} ms, hashes {hashes_seconds * 1e3:.2f} ms)"
+              + ("" if has_ffmpeg else f"  same samples: {np.array_equal(file_audio, memory_audio)}"))
+
+
+#
+# micro-batched lookups of concurrent queries
+#
+
+def benchmark_query_batching(audio_paths: list[str] = None, n_clients: int = 16, n_queries: int = 128):
+    """
+    throughput and latency of `n_queries` sample queries scored by `n_clients` concurrent
+    threads, each query looked up on its own (`score_hashes()`) or through
+    `search.QueryBatcher`, in SQLite and in the in-memory index
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import fingerprint_index
+    import search
+
+    queries = sample_queries(audio_paths, n_queries=n_queries)
+    with temporary_library(audio_paths, n_songs=32) as DBcontrol:
+        with contextlib.redirect_stdout(io.StringIO()):
+            DBcontrol.compute_source_hashes()
+
+        original_index = fingerprint_index.index
+        try:
+            for index_name, index in (("sqlite", None), ("memory", fingerprint_index.MemoryIndex.from_database())):
+                fingerprint_index.index = index
+                for batched in (False, True):
+                    batcher = search.QueryBatcher() if batched else None
+                    # every query is looked up, none is answered from the result cache
+                    search.invalidate_result_cache()
+
+                    def timed_query(hashes):
+                        start = time.perf_counter()
+                        if batcher is None:
+                            scores = search.score_hashes(hashes, index)[0][:1]
+                        else:
+                            scores = batcher.score(hashes, top_k=1)
+                        return scores, time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    with ThreadPoolExecutor(max_workers=n_clients) as clients:
+                        results = list(clients.map(timed_query, queries))
+                    seconds = time.perf_counter() - start
+                    if batcher is not None:
+                        batcher.close()
+
+                    latencies = np.array([latency for _, latency in results]) * 1e3
+                    print(f"{index_name:>7} {'batched' if batched else 'single':>8}: "
+                          f"{len(queries) / seconds:7.1f} queries/s  p50 {np.percentile(latencies, 50):6.1f} ms  "
+                          f"p99 {np.percentile(latencies, 99):6.1f} ms")
+        finally:
+            fingerprint_index.index = original_index
+
+
+#
+# query result cache
+#
+
+def benchmark_result_cache(audio_paths: list[str] = None):
+    """
+    time to score sample queries with `score_hashes()` and when they are answered from
+    `search.result_cache` (a repeated upload), in SQLite and in the in-memory index
+    """
+    import fingerprint_index
+    import search
+
+    queries = sample_queries(audio_paths)
+    with temporary_library(audio_paths, n_songs=32) as DBcontrol:
+        with contextlib.redirect_stdout(io.StringIO()):
+            DBcontrol.compute_source_hashes()
+
+        for index_name, index in (("sqlite", None), ("memory", fingerprint_index.MemoryIndex.from_database())):
+            _, miss_seconds = time_call(lambda: [search.score_hashes(hashes, index) for hashes in queries])
+            search.invalidate_result_cache()
+            for hashes in queries:
+                search.score_hashes_cached(hashes, index)
+            _, hit_seconds = time_call(lambda: [search.score_hashes_cached(hashes, index) for hashes in queries])
+            search.invalidate_result_cache()
+            print(f"{index_name:>7}: {miss_seconds / len(queries) * 1e3:7.2f} ms per query scored, "
+                  f"{hit_seconds / len(queries) * 1e3:5.2f} ms from the result cache")
+
+
+#
+# instrumentation overhead
+#
+
+def benchmark_instrumentation(audio_paths: list[str] = None, n_calls: int = 100_000):
+    """
+    time to recognize each sample (fingerprinting and scoring against the in-memory index
+    of its own hashes) outside `metrics.record()` and inside it,
+    and the cost of one stage that is not being measured
+    """
+    import metrics
+    from fingerprint_index import MemoryIndex
+    from search import score_hashes
+
+    for name, audio, sr in load_inputs(audio_paths):
+        hashes = create_hashes(create_constellation_map(audio, sr), sr)
+        index = MemoryIndex(hashes[0], np.ones(len(hashes[0]), dtype=np.int32), hashes[1])
+
+        def recognize():
+            return score_hashes(create_hashes(create_constellation_map(audio, sr), sr), index)
+
+        def recognize_measured():
+            with metrics.record(force=True) as stats:
+                recognize()
+            return stats
+
+        _, off_seconds = time_call(recognize)
+        stats, on_seconds = time_call(recognize_measured)
+        print(f"{name}: {off_seconds * 1e3:7.2f} ms not measured, {on_seconds * 1e3:7.2f} ms measured  "
+              f"({', '.join(f'{stage} {ms:.2f}' for stage, ms in stats.stages_ms.items())} ms)")
+
+    def unmeasured_stages():
+        for _ in range(n_calls):
+            with metrics.timed("stage"):
+                pass
+    _, seconds = time_call(unmeasured_stages, repeat=3)
+    print(f"stage outside record(): {seconds / n_calls * 1e9:.0f} ns")
+
+
+benchmarks = {
+    "fingerprint_formats": benchmark_fingerprint_formats,
+    "ingestion": benchmark_ingestion,
+    "parallel_ingestion": benchmark_parallel_ingestion,
+    "hash_layouts": benchmark_hash_layouts,
+    "memory_index": benchmark_memory_index,
+    "mmap_index": benchmark_mmap_index,
+    "progressive_search": benchmark_progressive_search,
+    "hash_df": benchmark_hash_df,
+    "streaming": benchmark_streaming,
+    "chunked_fingerprinting": benchmark_chunked_fingerprinting,
+    "audio_cache": benchmark_audio_cache,
+    "grid_cache": benchmark_grid_cache,
+    "upload_decoding": benchmark_upload_decoding,
+    "query_batching": benchmark_query_batching,
+    "result_cache": benchmark_result_cache,
+    "instrumentation": benchmark_instrumentation,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        benchmarks[sys.argv[1]](sys.argv[2:])
+    else:
+        for name, benchmark in benchmarks.items():
+            print(f"=== {name} ===")
+            benchmark()
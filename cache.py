@@ -0,0 +1,116 @@
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+# arrays that are expensive to recompute (decoded audio, see cm_helper.preprocess_audio())
+# are kept in this directory as .npy files, None disables the cache
+cache_dir = "sql/cache"
+
+# least recently used files are deleted once the cache is larger than this
+max_cache_bytes = 4 << 30
+
+# content digest of each file seen by this process, keyed by (path, size, mtime),
+# so an unchanged file is only read once to hash it
+_file_digests = {}
+
+
+def file_digest(path) -> str:
+    """
+    SHA-1 of the contents of `path`: a renamed or copied file has the same digest,
+    a file that was overwritten gets a new one
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            while block := f.read(1 << 20):
+                digest.update(block)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+def load_array(name: str) -> np.ndarray|None:
+    """
+    returns the cached array `name` memory-mapped (copy-on-write: writing to it
+    does not change the file), or `None` if it is not cached
+    """
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, name)
+    try:
+        array = np.load(path, mmap_mode="c")
+        # the modification time orders files for eviction, see evict()
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return array
+
+
+def store_array(name: str, array: np.ndarray) -> None:
+    """
+    writes `array` to the cache as `name`, then evicts files if the cache is too large
+
+    the file is written under a temporary name and renamed into place, so other
+    processes never load a partly written file
+    """
+    if cache_dir is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as f:
+        np.save(f, array)
+    os.replace(f.name, os.path.join(cache_dir, name))
+    evict()
+
+
+def evict(max_bytes: int = None) -> int:
+    """
+    deletes the least recently used files until the cache is at most `max_bytes`
+    (default `max_cache_bytes`), returns the number of bytes deleted
+
+    processes that already mapped a deleted file keep reading it
+    """
+    max_bytes = max_cache_bytes if max_bytes is None else max_bytes
+    entries = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".npy"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    deleted = 0
+    for _, size, path in sorted(entries):
+        if total - deleted <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # evicted by another process
+        deleted += size
+    return deleted
+
+
+def clear_cache() -> None:
+    """
+    deletes every cached file
+    """
+    if cache_dir is not None and os.path.isdir(cache_dir):
+        evict(max_bytes=0)
+
+
+def audio_name(audio_path, sr: int) -> str:
+    """
+    cache file name of the audio of `audio_path` decoded at `sr` Hz
+    """
+    return f"audio_{file_digest(audio_path)}_{sr}.npy"
+
+
+def parameters_digest(*parameters) -> str:
+    """
+    short digest of JSON-serializable parameters, for cache file names
+    """
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:16]
@@ -1,7 +1,13 @@
+import os
+
 import numpy as np
 import librosa
-from scipy import signal
+from scipy import signal, fft
+
+import cache
+import metrics
 
+@metrics.stage("compute_stft")
 def compute_stft(audio, sr, n_fft: int = None, hop_length: int = None):
     """
     compute a short-time fourier transform on the audio data to get the frequency spectrum
@@ -59,12 +65,88 @@ def compute_stft(audio, sr, n_fft: int = None, hop_length: int = None):
     #           that for each time step gives a spectrum: an array of frequency bins
     return frequencies, times, magnitude
 
-def preprocess_audio(audio_path, sr = 11_025):
+class StreamingSTFT:
+    """
+    `compute_stft()` over audio that arrives in chunks, e.g. from a microphone.
+    The frames are the same as `compute_stft()` of the whole audio
+
+    ```
+    stft = StreamingSTFT(sr)
+    for chunk in chunks:
+        magnitude = stft.push(chunk)  # (len(stft.frequencies), n_new_frames)
+    magnitude = stft.finish()         # last frames, padded with zeros
+    ```
+
+    only the samples of frames that are not complete yet are kept in memory
+    """
+
+    def __init__(self, sr, n_fft: int = None, hop_length: int = None):
+        self.n_fft = 1024 if n_fft is None else n_fft
+        self.hop_length = self.n_fft + (self.n_fft // 2) if hop_length is None else hop_length
+        self.frequencies = np.fft.rfftfreq(self.n_fft, 1 / sr)
+
+        # same arithmetic as signal.stft(): the window is applied in complex64
+        # and the audio in float64, then scaled by 1 / sum(window)
+        self.window = signal.get_window("hamming", self.n_fft).astype(np.complex64)
+        self.scale = np.sqrt(1.0 / self.window.sum() ** 2)
+
+        # signal.stft() pads the audio with n_fft // 2 zeros on both sides ("boundary")
+        self.buffer = np.zeros(self.n_fft // 2, dtype=np.float64)
+        # with hop_length > n_fft, the samples between two frames are never used
+        self.n_skip = 0
+        self.n_samples = 0
+        self.n_frames = 0
+
+    def push(self, audio) -> np.ndarray:
+        """
+        returns the magnitude of the frames completed by `audio`
+        """
+        self.n_samples += len(audio)
+        skipped = min(self.n_skip, len(audio))
+        self.n_skip -= skipped
+        self.buffer = np.concatenate((self.buffer, np.asarray(audio[skipped:], dtype=np.float64)))
+        return self._complete_frames()
+
+    def finish(self) -> np.ndarray:
+        """
+        returns the remaining frames, padding the audio with zeros like `signal.stft(padded=True)`
+        """
+        n_total_frames = (self.n_samples + (-self.n_samples % self.hop_length) % self.n_fft) // self.hop_length + 1
+        n_padding = (n_total_frames - self.n_frames - 1) * self.hop_length + self.n_fft - len(self.buffer)
+        self.buffer = np.concatenate((self.buffer, np.zeros(max(n_padding, 0))))
+        self.n_skip = 0
+        return self._complete_frames()
+
+    def _complete_frames(self) -> np.ndarray:
+        n_new = (len(self.buffer) - self.n_fft) // self.hop_length + 1 if len(self.buffer) >= self.n_fft else 0
+        starts = np.arange(n_new) * self.hop_length
+        segments = self.buffer[starts[:, None] + np.arange(self.n_fft)]
+        stft = fft.rfft((self.window * segments).real, axis=1)
+        stft *= self.scale
+        if n_new:
+            self.n_skip = max(n_new * self.hop_length - len(self.buffer), 0)
+        self.buffer = self.buffer[n_new * self.hop_length:]
+        self.n_frames += n_new
+        return np.abs(stft.astype(np.complex64)).T
+
+def preprocess_audio(audio_path, sr = 11_025, use_cache: bool = True):
     """
     returns `(audio, sr)`
 
     Common resampling rates: 11025 Hz, 44100 Hz
+
+    the decoded audio is cached on disk by file contents and sampling rate (see cache.py),
+    later calls memory-map it instead of decoding and resampling the file again.
+    `use_cache=False` for files that are only read once (e.g. uploaded samples)
     """
+    cache_name = None
+    if use_cache and cache.cache_dir is not None and isinstance(audio_path, (str, os.PathLike)):
+        sr = audio_sampling_rate(audio_path, sr)
+        cache_name = cache.audio_name(audio_path, sr)
+        audio = cache.load_array(cache_name)
+        if audio is not None:
+            return audio, sr
+
     # uses a low pass filter to filter the higher frequencies to avoid aliasing (Nyquist-Shannon)
     # then takes sequential samples of size 4 and keeps the first of each ("decimate")
     audio, sr = librosa.load(audio_path, sr=sr)
@@ -79,8 +161,113 @@ def preprocess_audio(audio_path, sr = 11_025):
     #sr = 11025
     #max_freq_cutoff = np.floor(sr/2)
 
+    if cache_name is not None:
+        cache.store_array(cache_name, audio)
     return audio, sr
 
+@metrics.stage("decode")
+def decode_audio_bytes(data: bytes, sr = 11_025):
+    """
+    returns `(audio, sr)` of an audio file held in memory (e.g. an upload),
+    mono float32 resampled to `sr`, without writing it to disk
+
+    formats soundfile reads (wav, flac, ogg, mp3) are decoded in this process and give the
+    same samples as `preprocess_audio()` of the file. Others (webm/opus recordings from
+    browsers, m4a) are piped through ffmpeg, see `decode_with_ffmpeg()`.
+    Raises `ValueError` if the data cannot be decoded
+    """
+    import io
+    import soundfile as sf
+
+    try:
+        audio, source_sr = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    except sf.LibsndfileError:
+        return decode_with_ffmpeg(data, sr)
+    # same steps as librosa.load(): average the channels, resample with soxr
+    audio = audio.mean(axis=1)
+    if sr is None or sr == source_sr:
+        return audio, source_sr
+    return librosa.resample(audio, orig_sr=source_sr, target_sr=sr, res_type="soxr_hq"), sr
+
+def decode_with_ffmpeg(data: bytes, sr = 11_025):
+    """
+    returns `(audio, sr)`: `data` decoded by an ffmpeg process straight to mono float32
+    at `sr` Hz, through its stdin and stdout (no temporary files)
+
+    raises `ValueError` when ffmpeg cannot decode `data` or cannot be run
+    """
+    import subprocess
+    try:
+        result = subprocess.run([
+            'ffmpeg', '-v', 'error',
+            '-i', 'pipe:0',
+            '-f', 'f32le',       # raw little-endian float32 samples
+            '-ac', '1',          # Mono
+            '-ar', str(sr),      # Sample rate
+            'pipe:1'
+        ], input=data, capture_output=True)
+    except OSError as e:
+        # ffmpeg not installed (FileNotFoundError) or not executable
+        raise ValueError(f"could not decode audio: ffmpeg is not available ({e.strerror})") from e
+    if result.returncode != 0:
+        message = result.stderr.decode(errors='replace').strip().splitlines()
+        raise ValueError("could not decode audio" + (f": {message[-1]}" if message else ""))
+    return np.frombuffer(result.stdout, dtype="<f4").astype(np.float32), sr
+
+def read_audio_blocks(audio_path, sr = 11_025, block_size: int = 1 << 16):
+    """
+    yields the audio of `preprocess_audio(audio_path, sr)` in consecutive blocks,
+    decoding and resampling `block_size` source samples at a time, so a long recording
+    never has to fit in memory. The blocks put together are the same samples
+    (librosa also mixes to mono by averaging the channels and resamples with soxr)
+
+    `sr=None` keeps the sampling rate of the file, see `audio_sampling_rate()`
+
+    formats soundfile cannot read (e.g. m4a, webm) are loaded whole with `preprocess_audio()`.
+    Audio cached by `preprocess_audio()` is read from the cache instead of decoded
+    """
+    import soundfile as sf
+    import soxr
+
+    if cache.cache_dir is not None:
+        # already decoded by preprocess_audio(): read the cached file block by block
+        audio = cache.load_array(cache.audio_name(audio_path, audio_sampling_rate(audio_path, sr)))
+        if audio is not None:
+            for start in range(0, len(audio), block_size):
+                yield np.array(audio[start:start + block_size])
+            return
+
+    try:
+        info = sf.info(audio_path)
+    except sf.LibsndfileError:
+        audio, _ = preprocess_audio(audio_path, sr)
+        for start in range(0, len(audio), block_size):
+            yield audio[start:start + block_size]
+        return
+
+    blocks = (block.mean(axis=1) for block in sf.blocks(audio_path, blocksize=block_size, dtype="float32", always_2d=True))
+    if sr is None or sr == info.samplerate:
+        yield from blocks
+        return
+
+    resampler = soxr.ResampleStream(info.samplerate, sr, 1, dtype="float32", quality="HQ")
+    # librosa trims or pads the resampled audio to ceil(n_samples * ratio) samples
+    n_remaining = int(np.ceil(info.frames * (float(sr) / info.samplerate)))
+    for block in blocks:
+        block = resampler.resample_chunk(block)[:n_remaining]
+        n_remaining -= len(block)
+        yield block
+    block = resampler.resample_chunk(np.empty(0, dtype=np.float32), last=True)[:n_remaining]
+    yield np.concatenate((block, np.zeros(n_remaining - len(block), dtype=np.float32)))
+
+def audio_sampling_rate(audio_path, sr = 11_025) -> int:
+    """
+    sampling rate of the blocks from `read_audio_blocks(audio_path, sr)`
+    """
+    if sr is not None:
+        return sr
+    return librosa.get_samplerate(audio_path)
+
 def add_noise(audio, noise_weight: float = 0.5):
 
     # brownian noise: x(n+1) = x(n) + w(n)
@@ -114,6 +301,6 @@ def create_samples(audio_path: str, sr: int = None, n_samples: int = 5, n_second
     np.random.seed(seed)
     start_indices = np.random.randint(0, max_start_idx, size=n_samples)
     for start_idx in start_indices:
-        sample = audio[start_idx:start_idx + window_size]
+        sample = np.array(audio[start_idx:start_idx + window_size])
         samples.append(sample)
     return samples
\ No newline at end of file
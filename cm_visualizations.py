@@ -17,9 +17,8 @@ def visualize_map_interactive(audio_path):
     magnitudes = convert_to_decibel(magnitudes)
     print(magnitudes.shape)
 
-    constellation_map = find_peaks(frequencies, times, magnitudes)
-    peak_times = [times[t] for t, f in constellation_map]
-    peak_freqs = [f for t, f in constellation_map]
+    peak_time_bins, peak_freqs = find_peaks(frequencies, times, magnitudes)
+    peak_times = times[peak_time_bins]
 
     fig = go.Figure()
 
@@ -1,15 +1,19 @@
 import numpy as np
 
-from cm_helper import compute_stft
+import cache
+import metrics
+from cm_helper import compute_stft, preprocess_audio, audio_sampling_rate, StreamingSTFT
 
 # Provided functions for finding if two peaks are "duplicates" (too close to each other)
-def peaks_are_duplicate(peak1: tuple[int, float] = None, peak2: tuple[int,float] = None):
+def peaks_are_duplicate(peak1: tuple[int, float], peak2: tuple[int, float],
+                        delta_time: int, delta_freq: float) -> bool:
+    """
+    the rule `remove_duplicate_peaks()` applies to every pair of peaks it compares:
+    within `delta_time` STFT bins and `delta_freq` Hz of each other
+    (the thresholds are set in parameters.json, see `parameters.py:set_parameters()`)
+    """
     if peak1 is None or peak2 is None:
         return False
-    
-    # Threshholds for considering two peaks as duplicates. Feel free to play around with these for your app.
-    delta_time = 10
-    delta_freq = 300
     t1, f1 = peak1
     t2, f2 = peak2
     if abs(t1 - t2) <= delta_time and abs(f1 - f2) <= delta_freq:
@@ -17,30 +21,97 @@ def peaks_are_duplicate(peak1: tuple[int, float] = None, peak2: tuple[int,float]
     return False
 
 # Function to remove duplicate peaks that are too close to each other
-def remove_duplicate_peaks(peaks: list[tuple[int, float]]):
-    # create a copy of the peaks list to avoid modifying the original list
-    peaksc=peaks.copy()
-    
-    # TODO: sort peaks by time
-    peaksc.sort(key=lambda x: x[0])
-    
-    # TODO: for each peak, search for duplicates within the next 15 peaks (ordered by time)
-    for index, peak in enumerate(peaksc):
-        i = 0
-        size = min(15, len(peaksc) - index - 1)
-        while (i < size):
-            #i goes from 0 to 14
-            if (peaks_are_duplicate(peaksc[index], peaks[index + i + 1])):
-                peaksc[index + i + 1] = None
-            i += 1
+def remove_duplicate_peaks(peak_times: np.ndarray, peak_freqs: np.ndarray,
+                           delta_time: int = None, delta_freq: float = None,
+                           lookahead: int = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    returns `(peak_times, peak_freqs)` with duplicate peaks removed, sorted by time (then frequency)
+
+    two peaks are duplicates if they are within `delta_time` STFT bins and `delta_freq` Hz
+    of each other (same rule as `peaks_are_duplicate()`). Visiting the peaks in order, a peak
+    is dropped if it is a duplicate of one of the `lookahead` peaks before it that was kept,
+    like the loop over `peaksc[i:i+15]` this replaces (see README.md)
+
+    `delta_time=None`, `delta_freq=None`, `lookahead=None` (default) read the values from parameters.json
+
+    works on arrays: the peaks are sorted by (time, frequency), so the result does not depend
+    on input order, and compared against shifted copies of themselves (`_suppress_close_peaks()`)
+    """
+    if delta_time is None or delta_freq is None or lookahead is None:
+        from parameters import read_parameters
+        default_delta_time, default_delta_freq, default_lookahead = read_parameters("duplicate_removal")
+        delta_time = default_delta_time if delta_time is None else delta_time
+        delta_freq = default_delta_freq if delta_freq is None else delta_freq
+        lookahead = default_lookahead if lookahead is None else lookahead
+
+    peak_times = np.asarray(peak_times)
+    peak_freqs = np.asarray(peak_freqs)
+    if len(peak_times) == 0:
+        return peak_times, peak_freqs
+
+    order = np.lexsort((peak_freqs, peak_times))
+    t = peak_times[order]
+    f = peak_freqs[order]
+    keep = _suppress_close_peaks(t, f, delta_time, delta_freq, lookahead)
+    return t[keep], f[keep]
+
+def _suppress_close_peaks(t: np.ndarray, f: np.ndarray, delta_time: int, delta_freq: float,
+                          lookahead: int) -> np.ndarray:
+    """
+    `t`, `f` sorted by time
+
+    returns a mask of the peaks to keep: visiting peaks in order, a peak is kept unless one of
+    the `lookahead` peaks before it was kept and is within `delta_time` and `delta_freq` of it
+    """
+    n = len(t)
+
+    # pairs (earlier, later) of peaks that are too close to each other.
+    # in time order, a peak's close neighbours are at most `max_offset` positions before it,
+    # so compare the sorted arrays against shifted copies of themselves
+    first_close = np.searchsorted(t, t - delta_time, side="left")
+    max_offset = min(int((np.arange(n) - first_close).max()) if n else 0, lookahead)
+    earlier, later = [np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.intp)]
+    for offset in range(1, max_offset + 1):
+        close = (t[offset:] - t[:-offset] <= delta_time) & (np.abs(f[offset:] - f[:-offset]) <= delta_freq)
+        i = np.flatnonzero(close)
+        earlier.append(i)
+        later.append(i + offset)
+    earlier = np.concatenate(earlier)
+    later = np.concatenate(later)
+
+    # a peak is kept iff none of its earlier close neighbours are kept.
+    # each round decides every peak that has a kept earlier neighbour (duplicate),
+    # or whose earlier neighbours have all been decided (kept)
+    keep = np.ones(n, dtype=bool)
+    decided = np.zeros(n, dtype=bool)
+    blocked = np.zeros(n, dtype=bool)
+    undecided = np.arange(n)
+    while len(undecided):
+        duplicates = later[decided[earlier] & keep[earlier]]
+        keep[duplicates] = False
+        decided[duplicates] = True
+
+        # only pairs between two undecided peaks can affect later rounds
+        active = ~decided[earlier] & ~decided[later]
+        earlier, later = earlier[active], later[active]
+        undecided = undecided[~decided[undecided]]
 
-    return [peak for peak in peaksc if peak is not None]
+        blocked[later] = True
+        ready = undecided[~blocked[undecided]]
+        blocked[later] = False
+        decided[ready] = True
+        undecided = undecided[~decided[undecided]]
+
+    return keep
 
 
 def find_peaks(frequencies, times, magnitude,
                              window_size=10,
-                             candidates_per_band=6):
-    return find_peaks_windowed(frequencies, times, magnitude, window_size, candidates_per_band)
+                             candidates_per_band=6) -> tuple[np.ndarray, np.ndarray]:
+    """
+    returns the constellation map as parallel arrays `(peak_times, peak_freqs)`, sorted by time
+    """
+    return find_peaks_vectorized(frequencies, times, magnitude, window_size, candidates_per_band)
 
 def find_peaks_windowed(frequencies, times, magnitude,
                              window_size=10,
@@ -115,10 +186,216 @@ def find_peaks_windowed(frequencies, times, magnitude,
             constellation_map.append((time, frequency))
 
     # Remove peaks that are too close to each other (treated as duplicates)
-    return remove_duplicate_peaks(constellation_map)
+    peak_times, peak_freqs = remove_duplicate_peaks(
+        np.array([peak[0] for peak in constellation_map], dtype=int),
+        np.array([peak[1] for peak in constellation_map], dtype=float),
+    )
+    return list(zip(peak_times, peak_freqs))
+
 
+def find_peaks_vectorized(frequencies, times, magnitude,
+                          window_size=10,
+                          candidates_per_band=6):
+    """
+    vectorized version of `find_peaks_windowed()`, returns the same peaks as
+    two parallel arrays `(peak_times, peak_freqs)` instead of a list of tuples
+
+    rather than looping over time windows and bands, each band of the spectrogram
+    is reshaped into a `(n_windows, band_height * window_size)` block
+    and the top `candidates_per_band` peaks of every window are taken in a single
+    batched `np.argpartition` call
+    """
+    from parameters import read_parameters
+    window_size, candidates_per_band, bands = read_parameters("constellation_mapping")
+
+    with metrics.timed("find_peaks"):
+        peak_times, peak_freqs = window_peak_candidates(frequencies, magnitude, window_size, candidates_per_band, bands)
+
+    # Remove peaks that are too close to each other (treated as duplicates)
+    with metrics.timed("remove_duplicate_peaks"):
+        peak_times, peak_freqs = remove_duplicate_peaks(peak_times, peak_freqs)
+    metrics.count("peaks", len(peak_times))
+    return peak_times, peak_freqs
+
+
+def window_peak_candidates(frequencies, magnitude, window_size, candidates_per_band, bands,
+                           first_time: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    the peaks `find_peaks_vectorized()` keeps in each window of `window_size` frames of
+    `magnitude`, before duplicate removal, sorted by window then magnitude (descending)
+
+    `first_time`: time index of the first frame of `magnitude`
+    """
+    num_freq_bins, num_time_bins = magnitude.shape
+    n_windows = -(-num_time_bins // window_size)
 
-def create_constellation_map(audio, sr, hop_length=None) -> list[list[int]]:
+    # pad the last (partial) window with -inf so padding is never picked as a peak
+    padded = np.full((num_freq_bins, n_windows * window_size), -np.inf, dtype=magnitude.dtype)
+    padded[:, :num_time_bins] = magnitude
+
+    window_starts = first_time + np.arange(n_windows) * window_size
+    cand_t, cand_f, cand_mag = [], [], []
+    for f_start, f_end in bands:
+        # (band_height, n_windows, window_size) -> (n_windows, band_height * window_size)
+        # each row is the flattened freq_square of one window
+        band = padded[f_start:f_end].reshape(f_end - f_start, n_windows, window_size)
+        band = band.transpose(1, 0, 2).reshape(n_windows, -1)
+
+        flat_indices = np.argpartition(band, -candidates_per_band, axis=1)[:, -candidates_per_band:]
+        f_local, t_local = np.divmod(flat_indices, window_size)
+        cand_t.append(window_starts[:, None] + t_local)
+        cand_f.append(f_start + f_local)
+        cand_mag.append(np.take_along_axis(band, flat_indices, axis=1))
+
+    # (n_windows, n_bands * candidates_per_band)
+    cand_t = np.concatenate(cand_t, axis=1)
+    cand_f = np.concatenate(cand_f, axis=1)
+    cand_mag = np.concatenate(cand_mag, axis=1)
+
+    # Keep top peaks per time window (sorted by magnitude, descending)
+    proportion_keep = 0.95
+    stell_cutoff = int(proportion_keep * cand_mag.shape[1])
+    order = np.argsort(-cand_mag, axis=1, kind="stable")[:, :stell_cutoff]
+
+    peak_times = np.take_along_axis(cand_t, order, axis=1).ravel()
+    peak_freqs = frequencies[np.take_along_axis(cand_f, order, axis=1).ravel()]
+    return peak_times, peak_freqs
+
+
+class StreamingPeakFinder:
+    """
+    `find_peaks()` over spectrogram frames that arrive in chunks (from `cm_helper.StreamingSTFT`).
+    Returns the same peaks as `find_peaks()` of the whole spectrogram
+
+    ```
+    stft = StreamingSTFT(sr)
+    peak_finder = StreamingPeakFinder(stft.frequencies)
+    for chunk in chunks:
+        peak_times, peak_freqs = peak_finder.push(stft.push(chunk))
+    peak_times, peak_freqs = peak_finder.push(stft.finish(), final=True)
+    ```
+
+    peaks are found once a whole window of `cm_window_size` frames has arrived. Duplicate
+    removal only looks back `lookahead` peaks, so only the last `lookahead` peaks are kept
+    """
+
+    def __init__(self, frequencies):
+        from parameters import read_parameters
+        self.frequencies = frequencies
+        self.window_size, self.candidates_per_band, self.bands = read_parameters("constellation_mapping")
+        self.delta_time, self.delta_freq, self.lookahead = read_parameters("duplicate_removal")
+
+        self.frames = np.empty((len(frequencies), 0), dtype=np.float32)
+        self.n_frames = 0  # time index of the first frame in self.frames
+        # last `lookahead` peaks before duplicate removal, dropped ones with a NaN frequency
+        self.recent_times = np.empty(0, dtype=np.int64)
+        self.recent_freqs = np.empty(0, dtype=np.float64)
+
+    def push(self, magnitude: np.ndarray, final: bool = False) -> tuple[np.ndarray, np.ndarray]:
+        """
+        returns the peaks `(peak_times, peak_freqs)` of the windows completed by `magnitude`,
+        `final=True` also returns the peaks of the last, partial window
+        """
+        self.frames = np.concatenate((self.frames, magnitude), axis=1)
+        n_complete = self.frames.shape[1] if final else self.frames.shape[1] // self.window_size * self.window_size
+        if n_complete == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+        peak_times, peak_freqs = window_peak_candidates(
+            self.frequencies, self.frames[:, :n_complete], self.window_size,
+            self.candidates_per_band, self.bands, first_time=self.n_frames
+        )
+        self.frames = self.frames[:, n_complete:]
+        self.n_frames += n_complete
+        return self._remove_duplicate_peaks(peak_times, peak_freqs)
+
+    def _remove_duplicate_peaks(self, peak_times, peak_freqs):
+        # same result as remove_duplicate_peaks() over every peak so far: new windows come
+        # after the earlier ones in (time, frequency) order, and whether a peak is kept only
+        # depends on the `lookahead` peaks before it. A peak that was dropped cannot
+        # suppress another one, its NaN frequency is never close to anything
+        order = np.lexsort((peak_freqs, peak_times))
+        t = np.concatenate((self.recent_times, peak_times[order]))
+        f = np.concatenate((self.recent_freqs, peak_freqs[order]))
+        keep = _suppress_close_peaks(t, f, self.delta_time, self.delta_freq, self.lookahead)
+
+        n_recent = len(self.recent_times)
+        self.recent_times = t[-self.lookahead:]
+        self.recent_freqs = np.where(keep, f, np.nan)[-self.lookahead:]
+        return t[n_recent:][keep[n_recent:]], f[n_recent:][keep[n_recent:]]
+
+
+def create_constellation_map(audio, sr, hop_length=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    returns `(peak_times, peak_freqs)`: STFT time bin index and frequency (Hz) of each peak
+    """
     frequencies, times, magnitude = compute_stft(audio, sr, hop_length=hop_length)
     constellation_map = find_peaks(frequencies, times, magnitude)
-    return constellation_map
\ No newline at end of file
+    return constellation_map
+
+
+def constellation_map_from_file(audio_path, sr=11_025, hop_length=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    `create_constellation_map()` of `preprocess_audio(audio_path, sr)`, with each stage
+    cached on disk (see cache.py) under the parameters it depends on:
+
+    ```
+    audio        file contents, sr                  (cm_helper.preprocess_audio())
+    spectrogram  + n_fft, hop_length
+    peaks        + constellation_mapping and duplicate_removal in parameters.json
+    ```
+
+    so a grid search that only changes `cm_window_size` reuses every spectrogram,
+    and a combination seen before reuses the peaks. Hashing is cheap and not cached
+    """
+    if cache.cache_dir is None:
+        audio, sr = preprocess_audio(audio_path, sr)
+        return create_constellation_map(audio, sr, hop_length)
+
+    from parameters import read_parameters
+    sr = audio_sampling_rate(audio_path, sr)
+    n_fft = 1024
+    hop_length = n_fft + (n_fft // 2) if hop_length is None else hop_length
+    stft_key = f"{cache.file_digest(audio_path)}_{sr}_{n_fft}_{hop_length}"
+    peaks_name = f"peaks_{stft_key}_" + cache.parameters_digest(
+        read_parameters("constellation_mapping"), read_parameters("duplicate_removal")
+    ) + ".npy"
+
+    peaks = cache.load_array(peaks_name)
+    if peaks is not None:
+        return peaks[0].astype(np.int64), np.array(peaks[1])
+
+    stft_name = f"stft_{stft_key}.npy"
+    magnitude = cache.load_array(stft_name)
+    if magnitude is None:
+        audio, sr = preprocess_audio(audio_path, sr)
+        _, _, magnitude = compute_stft(audio, sr, n_fft=n_fft, hop_length=hop_length)
+        cache.store_array(stft_name, magnitude)
+    frequencies = np.fft.rfftfreq(n_fft, 1 / sr)
+
+    peak_times, peak_freqs = find_peaks(frequencies, None, magnitude)
+    # peak times (frame indices) are exact in float64
+    cache.store_array(peaks_name, np.stack((peak_times.astype(np.float64), peak_freqs)))
+    return peak_times, peak_freqs
+
+def stream_constellation_map(audio_blocks, sr, hop_length=None):
+    """
+    yields the constellation map of audio that arrives in blocks
+    (e.g. `cm_helper.read_audio_blocks()`), as `(peak_times, peak_freqs)` chunks in time order
+
+    ```
+    for peak_times, peak_freqs in stream_constellation_map(read_audio_blocks(audio_path), 11025):
+        ...
+    ```
+
+    the chunks put together are the peaks of `create_constellation_map()` of the whole audio.
+    Only the samples and frames of the current block (plus one STFT frame and one
+    peak window of overlap) are in memory at a time, however long the recording is
+    """
+    stft = StreamingSTFT(sr, hop_length=hop_length)
+    peak_finder = StreamingPeakFinder(stft.frequencies)
+    for block in audio_blocks:
+        peak_times, peak_freqs = peak_finder.push(stft.push(block))
+        if len(peak_times):
+            yield peak_times, peak_freqs
+    yield peak_finder.push(stft.finish(), final=True)
@@ -0,0 +1,251 @@
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from DBcontrol import connect
+
+# index loaded by load_memory_index() or load_mmap_index(), used by search.recognize_music()
+# for lookups and kept up to date by DB_adder.add_song(). None: look up hashes in SQLite
+index = None
+
+# directory written by export_mmap_index()
+mmap_index_dir = "sql/fingerprint_index"
+
+
+def expand_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    returns the indices `starts[0], ..., starts[0] + counts[0] - 1, starts[1], ...` as one array
+    """
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets
+
+
+class MemoryIndex:
+    """
+    the hashes table held in memory, as parallel arrays sorted by hash_val
+
+    ```
+    hash_vals[i], song_ids[i], time_stamps[i]  # i-th row of the hashes table
+    ```
+
+    the rows matching a hash value are a contiguous slice of the arrays,
+    found with a binary search (`np.searchsorted`)
+    """
+
+    def __init__(self, hash_vals: np.ndarray, song_ids: np.ndarray, time_stamps: np.ndarray):
+        order = np.argsort(hash_vals, kind="stable")
+        # lookups read this tuple once, add() replaces it with a new one,
+        # so a lookup never sees a half-updated index
+        self._arrays = (
+            np.asarray(hash_vals, dtype=np.uint32)[order],
+            np.asarray(song_ids, dtype=np.int32)[order],
+            np.asarray(time_stamps, dtype=np.int32)[order],
+        )
+        # number of songs, for IDF weights (see search.py)
+        self.n_songs = len(np.unique(song_ids))
+        self._write_lock = threading.Lock()
+
+    @classmethod
+    def from_database(cls, fetch_size: int = 1 << 16) -> "MemoryIndex":
+        """
+        loads every row of the hashes table of `DBcontrol.library`
+        """
+        con = connect()
+        cur = con.cursor()
+        cur.execute("SELECT hash_val, song_id, time_stamp FROM hashes")
+        chunks = [np.empty((0, 3), dtype=np.int64)]
+        while rows := cur.fetchmany(fetch_size):
+            chunks.append(np.array(rows, dtype=np.int64))
+        con.close()
+        rows = np.concatenate(chunks)
+        return cls(rows[:, 0], rows[:, 1], rows[:, 2])
+
+    def __len__(self) -> int:
+        return len(self._arrays[0])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in self._arrays)
+
+    def lookup(self, hash_vals: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        returns parallel arrays `(hash_vals, song_ids, time_stamps)` of every row
+        matching one of `hash_vals`, like `DBcontrol.retrieve_postings()`
+        """
+        index_hash_vals, index_song_ids, index_time_stamps = self._arrays
+        hash_vals = np.unique(np.asarray(hash_vals, dtype=np.uint32))
+        starts = np.searchsorted(index_hash_vals, hash_vals, side="left")
+        ends = np.searchsorted(index_hash_vals, hash_vals, side="right")
+        rows = expand_ranges(starts, ends - starts)
+        return index_hash_vals[rows], index_song_ids[rows], index_time_stamps[rows]
+
+    def add(self, song_id: int, hashes: tuple[np.ndarray, np.ndarray]) -> None:
+        """
+        adds the fingerprints of a song that was inserted into the database
+
+        hashes: `(hash_vals, anchor_times)` arrays from `hasher.create_hashes()`
+        """
+        new_hash_vals, new_time_stamps = hashes
+        order = np.argsort(new_hash_vals, kind="stable")
+        new_hash_vals = np.asarray(new_hash_vals, dtype=np.uint32)[order]
+        new_time_stamps = np.asarray(new_time_stamps, dtype=np.int32)[order]
+
+        with self._write_lock:
+            hash_vals, song_ids, time_stamps = self._arrays
+            # a song fingerprinted again is not counted twice
+            new_song = not np.any(song_ids == song_id)
+            # merge the two sorted arrays without re-sorting the whole index
+            positions = np.searchsorted(hash_vals, new_hash_vals, side="right")
+            self._arrays = (
+                np.insert(hash_vals, positions, new_hash_vals),
+                np.insert(song_ids, positions, np.int32(song_id)),
+                np.insert(time_stamps, positions, new_time_stamps),
+            )
+            self.n_songs += new_song
+
+
+class MmapIndex:
+    """
+    the hashes table exported by `export_mmap_index()`, memory-mapped from `index_dir`:
+
+    ```
+    hash_vals.npy    # uint32, every distinct hash value, sorted (the hash directory)
+    offsets.npy      # int64, postings of hash_vals[i] are rows offsets[i]:offsets[i + 1]
+    song_ids.npy     # int32, postings sorted by hash_val
+    time_stamps.npy  # int32
+    n_songs.npy      # number of songs, for IDF weights (see search.py)
+    ```
+
+    nothing is read into memory when the index is opened, the OS pages in the parts
+    a lookup touches. Processes mapping the same files share one copy in the page cache
+
+    songs added after the export are held in memory by this process (see `add()`),
+    export again to make them visible to other processes
+    """
+
+    def __init__(self, index_dir: str = None):
+        index_dir = index_dir or mmap_index_dir
+        self.index_dir = index_dir
+        self.hash_vals, self.offsets, self.song_ids, self.time_stamps = (
+            np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+            for name in ("hash_vals", "offsets", "song_ids", "time_stamps")
+        )
+        self.exported_n_songs = int(np.load(os.path.join(index_dir, "n_songs.npy")))
+        empty = np.empty(0, dtype=np.int32)
+        self.added = MemoryIndex(empty.astype(np.uint32), empty, empty)
+
+    @property
+    def n_songs(self) -> int:
+        return self.exported_n_songs + self.added.n_songs
+
+    def __len__(self) -> int:
+        return len(self.song_ids) + len(self.added)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        size of the mapped files (not resident memory)
+        """
+        return sum(a.nbytes for a in (self.hash_vals, self.offsets, self.song_ids, self.time_stamps))
+
+    def lookup(self, hash_vals: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        returns parallel arrays `(hash_vals, song_ids, time_stamps)` of every row
+        matching one of `hash_vals`, like `DBcontrol.retrieve_postings()`
+        """
+        hash_vals = np.unique(np.asarray(hash_vals, dtype=np.uint32))
+        positions = np.searchsorted(self.hash_vals, hash_vals)
+        # keep the hash values that are in the directory
+        found = positions < len(self.hash_vals)
+        found[found] = self.hash_vals[positions[found]] == hash_vals[found]
+        positions = positions[found]
+        starts = self.offsets[positions]
+        counts = self.offsets[positions + 1] - starts
+        rows = expand_ranges(starts, counts)
+        postings = (np.repeat(self.hash_vals[positions], counts), self.song_ids[rows], self.time_stamps[rows])
+        if not len(self.added):
+            return postings
+        return tuple(np.concatenate(arrays) for arrays in zip(postings, self.added.lookup(hash_vals)))
+
+    def add(self, song_id: int, hashes: tuple[np.ndarray, np.ndarray]) -> None:
+        """
+        adds the fingerprints of a song that was inserted into the database
+        after the index was exported, see `MemoryIndex.add()`
+        """
+        self.added.add(song_id, hashes)
+
+
+def export_mmap_index(index_dir: str = None, fetch_size: int = 1 << 16) -> str:
+    """
+    writes the hashes table of `DBcontrol.library` to `index_dir` (default `mmap_index_dir`)
+    in the format read by `MmapIndex`, replacing any previous export
+
+    rows are streamed from SQLite in hash order, so the table is never held in memory
+    (fastest with the clustered layout, see `DBcontrol.migrate_hash_layout()`, which stores
+    rows in that order)
+    """
+    index_dir = index_dir or mmap_index_dir
+    tmp_dir = index_dir.rstrip("/") + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    con = connect()
+    cur = con.cursor()
+    n_rows = cur.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+    n_songs = cur.execute("SELECT COUNT(DISTINCT song_id) FROM hashes").fetchone()[0]
+    song_ids, time_stamps = (
+        np.lib.format.open_memmap(os.path.join(tmp_dir, f"{name}.npy"), mode="w+", dtype=np.int32, shape=(n_rows,))
+        for name in ("song_ids", "time_stamps")
+    )
+    # distinct hash values and their number of postings, one pair of arrays per chunk
+    directory_hash_vals, directory_counts = [np.empty(0, dtype=np.uint32)], [np.empty(0, dtype=np.int64)]
+
+    cur.execute("SELECT hash_val, song_id, time_stamp FROM hashes ORDER BY hash_val")
+    row = 0
+    while rows := cur.fetchmany(fetch_size):
+        rows = np.array(rows, dtype=np.int64)
+        song_ids[row:row + len(rows)] = rows[:, 1]
+        time_stamps[row:row + len(rows)] = rows[:, 2]
+        row += len(rows)
+
+        chunk_hash_vals, chunk_counts = np.unique(rows[:, 0].astype(np.uint32), return_counts=True)
+        # a hash value's postings can continue from the previous chunk
+        if len(directory_hash_vals[-1]) and directory_hash_vals[-1][-1] == chunk_hash_vals[0]:
+            directory_counts[-1][-1] += chunk_counts[0]
+            chunk_hash_vals, chunk_counts = chunk_hash_vals[1:], chunk_counts[1:]
+        directory_hash_vals.append(chunk_hash_vals)
+        directory_counts.append(chunk_counts.astype(np.int64))
+    con.close()
+    song_ids.flush()
+    time_stamps.flush()
+    del song_ids, time_stamps
+
+    counts = np.concatenate(directory_counts)
+    np.save(os.path.join(tmp_dir, "hash_vals.npy"), np.concatenate(directory_hash_vals))
+    np.save(os.path.join(tmp_dir, "offsets.npy"), np.concatenate(([0], np.cumsum(counts))).astype(np.int64))
+    np.save(os.path.join(tmp_dir, "n_songs.npy"), np.int64(n_songs))
+
+    # processes that already mapped the old files keep reading them until they reopen the index
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.rename(tmp_dir, index_dir)
+    return index_dir
+
+
+def load_memory_index() -> MemoryIndex:
+    """
+    loads the hashes table into `index`, call once at startup
+    """
+    global index
+    index = MemoryIndex.from_database()
+    return index
+
+
+def load_mmap_index(index_dir: str = None) -> MmapIndex:
+    """
+    opens the index written by `export_mmap_index()` as `index`, call once at startup
+    """
+    global index
+    index = MmapIndex(index_dir)
+    return index
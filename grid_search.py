@@ -1,6 +1,10 @@
+import os
+import json
+import time
 import numpy as np
 import pandas as pd
 from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from cm_visualizations import visualize_map_interactive
 from cm_helper import create_samples, add_noise
@@ -10,6 +14,9 @@ from const_map import create_constellation_map
 from hasher import create_hashes
 from search import score_hashes
 
+import cache
+import DBcontrol
+import parameters as parameter_store
 from parameters import set_parameters, read_parameters
 from pathlib import Path
 
@@ -164,11 +171,11 @@ def perform_recognition_test(n_songs=None):
 
         # peaks -> hashes
         constellation_map = create_constellation_map(sample["microphone"], sr=sr)
-        hashes = create_hashes(constellation_map, None, sr)
+        hashes = create_hashes(constellation_map, sr)
 
         # hashes -> metrics
         scores, time_pair_bins = score_hashes(hashes)
-        n_sample_hashes = len(hashes)
+        n_sample_hashes = len(hashes[0])
         n_potential_matches = min(len(scores), 5)
         metrics_per_potential_match = {}
         for potential_song_id, potential_score in scores[:n_potential_matches]:
@@ -228,6 +235,158 @@ def run_grid_search(n_songs=None):
     
 
 
+
+#
+# parallel, resumable grid search
+#
+
+# results of run_parallel_grid_search(), one JSON object per line
+grid_results_path = "grid_results.jsonl"
+
+# parameters.json and library.db of each combination being evaluated
+grid_work_dir = "sql/grid_search"
+
+def parameter_grid(**values: list) -> list[dict]:
+    """
+    every combination of the listed values, as keyword arguments of `set_parameters()`
+
+    ```
+    parameter_grid(cm_window_size=[4, 5, 10], candidates_per_band=[5, 7])
+    # [{"cm_window_size": 4, "candidates_per_band": 5},
+    #  {"cm_window_size": 4, "candidates_per_band": 7}, ...]
+    ```
+    """
+    return [dict(zip(values, combination)) for combination in product(*values.values())]
+
+
+def combination_key(combination: dict) -> str:
+    """
+    identifies a combination in the results file and names its work files
+    """
+    return cache.parameters_digest(combination)
+
+
+def evaluate_combination(combination: dict, n_songs=None, work_dir: str = None,
+                         keep_database: bool = False) -> dict:
+    """
+    runs `perform_recognition_test()` with the parameters in `combination`
+    (unspecified parameters get the `set_parameters()` defaults)
+
+    the combination gets its own parameters.json and library.db in `work_dir`
+    (default `grid_work_dir`), so several can be evaluated at once in separate processes.
+    The database is deleted afterwards unless `keep_database=True`
+
+    returns a JSON-serializable result:
+    ```
+    {"key": ..., "combination": {...}, "parameters": read_parameters("all_parameters"),
+     "proportion_correct": ..., "n_samples": ..., "seconds": wall-clock time,
+     "index_bytes": database size, "n_hashes": ..., "error": None or a description}
+    ```
+    """
+    work_dir = work_dir or grid_work_dir
+    os.makedirs(work_dir, exist_ok=True)
+    key = combination_key(combination)
+    parameter_store.parameters_json = os.path.join(work_dir, f"parameters_{key}.json")
+    DBcontrol.library = os.path.join(work_dir, f"library_{key}.db")
+
+    result = {"key": key, "combination": combination, "parameters": set_parameters(**combination)}
+    start = time.perf_counter()
+    try:
+        proportion_correct, results = perform_recognition_test(n_songs)
+        result["seconds"] = time.perf_counter() - start
+        result["proportion_correct"] = proportion_correct
+        result["n_samples"] = len(results)
+        result["index_bytes"] = sum(
+            os.path.getsize(path) for path in (DBcontrol.library, DBcontrol.library + "-wal")
+            if os.path.exists(path)
+        )
+        with connect() as con:
+            result["n_hashes"] = con.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        con.close()
+        result["error"] = None
+    except Exception as e:
+        result["seconds"] = time.perf_counter() - start
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    work_files = [parameter_store.parameters_json]
+    if not keep_database:
+        work_files += [DBcontrol.library + suffix for suffix in ("", "-wal", "-shm")]
+    for path in work_files:
+        if os.path.exists(path):
+            os.remove(path)
+    return result
+
+
+def load_grid_results(results_path: str = None) -> list[dict]:
+    """
+    results written by `run_parallel_grid_search()`; a last line cut off
+    by an interrupted run is ignored
+    """
+    results_path = results_path or grid_results_path
+    if not os.path.exists(results_path):
+        return []
+    results = []
+    with open(results_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                results.append(json.loads(line))
+            except json.JSONDecodeError:
+                pass
+    return results
+
+
+def run_parallel_grid_search(grid: list[dict], n_songs=None, n_workers: int = None,
+                             results_path: str = None, work_dir: str = None,
+                             keep_databases: bool = False) -> list[dict]:
+    """
+    evaluates every combination of `grid` (see `parameter_grid()`) with
+    `evaluate_combination()` in `n_workers` processes (`None`: one per CPU core)
+
+    each result is appended to `results_path` (default `grid_results_path`) as soon as
+    it finishes. Combinations that already have a result there (without an error)
+    are skipped, so an interrupted sweep resumes where it stopped
+
+    returns every result for `grid`, best `proportion_correct` first
+
+    ```
+    grid = parameter_grid(cm_window_size=[4, 5, 10], candidates_per_band=[5, 7])
+    results = run_parallel_grid_search(grid, n_songs=2, n_workers=4)
+    pd.DataFrame(results)[["combination", "proportion_correct", "seconds", "index_bytes"]]
+    ```
+    """
+    results_path = results_path or grid_results_path
+    done = {
+        result["key"]: result for result in load_grid_results(results_path)
+        if result.get("error") is None
+    }
+    pending = [combination for combination in grid if combination_key(combination) not in done]
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool, open(results_path, "a+", encoding="utf-8") as f:
+            # start on a new line after a line cut off by an interrupted run
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                if f.read(1) != "\n":
+                    f.write("\n")
+            futures = [
+                pool.submit(evaluate_combination, combination, n_songs, work_dir, keep_databases)
+                for combination in pending
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                # one line per result, flushed so that it survives an interruption
+                f.write(json.dumps(result) + "\n")
+                f.flush()
+                if result["error"] is None:
+                    done[result["key"]] = result
+                else:
+                    print(f"{result['combination']}: {result['error']}")
+
+    results = [done[combination_key(combination)] for combination in grid if combination_key(combination) in done]
+    return sorted(results, key=lambda result: -result["proportion_correct"])
+    
+
+
 if __name__ == "__main__":
     max_results, max_params = run_grid_search(n_songs=2)
     print("=============")
@@ -1,6 +1,8 @@
 import numpy as np
 from scipy import signal
 
+import metrics
+
 # TODO: Finish this function to compute the hash of two peaks
 def create_address(anchor: tuple[int, int], target: tuple[int, int], sr: int) -> int:
     
@@ -36,47 +38,175 @@ def create_address(anchor: tuple[int, int], target: tuple[int, int], sr: int) ->
     hash = int(anchor_freq) | (int(target_freq) << 10) | (int(deltaT) << 20)
     return hash
 
-def create_hashes(peaks, song_id: int = None, sr: int = None, fanout_t=100, fanout_f=3000):
+def create_hashes(peaks: tuple[np.ndarray, np.ndarray], sr: int = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    peaks: constellation map `(peak_times, peak_freqs)` from `const_map.create_constellation_map()`
+
+    returns the fingerprints of the audio as parallel arrays `(hash_vals, anchor_times)`,
+    one entry per (anchor, target) pair, see `create_hash_arrays()`
+
+    ```
+    hash_vals, anchor_times = create_hashes(constellation_map, sr)
+    # the i-th fingerprint
+    address, anchorT = hash_vals[i], anchor_times[i]
+    ```
+
+    the target zone is read from parameters.json (`fanout_t`, `fanout_f`)
+    """
+    # Arrays instead of a {hash: (time, song_id)} dictionary:
+    # a dictionary keeps only the last time an address occurs in a song
+    # (repeated addresses overwrite each other), and costs ~100 bytes per entry
+    # instead of 8 bytes per fingerprint.
+    # The song_id is the same for every fingerprint of a song, so it is passed
+    # separately to `DBcontrol.add_hashes(hashes, song_id)`
+    peak_times, peak_freqs = peaks
+    with metrics.timed("create_hashes"):
+        hashes = create_hash_arrays(peak_times, peak_freqs, sr)
+    metrics.count("hashes", len(hashes[0]))
+    return hashes
+
+def quantize_frequencies(freqs: np.ndarray, sr: int) -> np.ndarray:
+    """
+    transform frequencies to fit in 10 bits (0-1023), see create_address()
+    """
+    max_frequency = np.ceil(sr / 2) + 10
+    n_bits = 10
+    return ((freqs / max_frequency) * (2 ** n_bits)).astype(np.uint32)
+
+# upper bound on the number of (anchor, target) pairs held in memory at once
+max_pairs_per_chunk = 1 << 22
+
+def create_hash_arrays(peak_times: np.ndarray, peak_freqs: np.ndarray, sr: int,
+                       fanout_t: int = None, fanout_f: float = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    array version of the anchor/target loop, returns parallel arrays `(hash_vals, anchor_times)`
+
+    ```
+    hash_vals:    np.uint32, 32 bit f1:f2:dt addresses (same as `create_address()`)
+    anchor_times: np.int32, time of the anchor point of each address
+    ```
+
+    every (anchor, target) pair inside the target zone is kept,
+    so an address can appear more than once
+
+    the target zone of an anchor at time `t` is the peaks in `(t + 1, t + fanout_t]`
+    with a frequency difference below `fanout_f`. Since peaks are sorted by time,
+    each zone is a contiguous slice found with `np.searchsorted`
+
+    `fanout_t=None`, `fanout_f=None` (default) read the target zone from parameters.json
+    """
+    if fanout_t is None or fanout_f is None:
+        from parameters import read_parameters
+        fanout_t, fanout_f = read_parameters("hashing")
+
+    order = np.argsort(peak_times, kind="stable")
+    t = np.asarray(peak_times, dtype=np.int64)[order]
+    f = np.asarray(peak_freqs, dtype=np.float64)[order]
+
+    quantized_freqs = quantize_frequencies(f, sr)
+
+    # target zone of anchor i: peaks zone_start[i]:zone_end[i]
+    zone_start = np.searchsorted(t, t + 1, side="right")
+    zone_end = np.searchsorted(t, t + fanout_t, side="right")
+    zone_sizes = zone_end - zone_start
+
+    hash_vals, anchor_times = [np.empty(0, dtype=np.uint32)], [np.empty(0, dtype=np.int32)]
+    anchors_per_chunk = max(1, max_pairs_per_chunk // max(int(zone_sizes.max(initial=0)), 1))
+    for chunk_start in range(0, len(t), anchors_per_chunk):
+        sizes = zone_sizes[chunk_start:chunk_start + anchors_per_chunk]
+
+        # one entry per (anchor, target) pair
+        anchors = np.repeat(np.arange(chunk_start, chunk_start + len(sizes)), sizes)
+        position_in_zone = np.arange(len(anchors)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        targets = zone_start[anchors] + position_in_zone
+
+        in_zone = np.abs(f[targets] - f[anchors]) < fanout_f
+        anchors, targets = anchors[in_zone], targets[in_zone]
+
+        # int(anchor_freq)         occupies bits 0-9,    anchor_freq <= 1023
+        # int(target_freq) << 10   occupies bits 10-19,  target_freq <= 1023
+        # int(deltaT) << 20        occupies bits 20-31,  deltaT <= 4095
+        deltaT = (t[targets] - t[anchors]).astype(np.uint32)
+        hash_vals.append(quantized_freqs[anchors] | (quantized_freqs[targets] << 10) | (deltaT << 20))
+        anchor_times.append(t[anchors].astype(np.int32))
+
+    return np.concatenate(hash_vals), np.concatenate(anchor_times)
+
+
+class StreamingHasher:
+    """
+    `create_hashes()` over peaks that arrive in time order (from `const_map.StreamingPeakFinder`).
+    Together, the hashes returned by `push()` are the same (anchor, target) pairs as
+    `create_hashes()` of every peak, in a different order
+
+    ```
+    hasher = StreamingHasher(sr)
+    for peaks in ...:
+        hash_vals, anchor_times = hasher.push(*peaks)
+    ```
+
+    each call pairs the new peaks, as targets, with the anchors up to `fanout_t` frames
+    before them, so only the peaks of the last `fanout_t` frames are kept
+    """
+
+    def __init__(self, sr: int, fanout_t: int = None, fanout_f: float = None):
+        if fanout_t is None or fanout_f is None:
+            from parameters import read_parameters
+            fanout_t, fanout_f = read_parameters("hashing")
+        self.sr = sr
+        self.fanout_t = fanout_t
+        self.fanout_f = fanout_f
+        self.peak_times = np.empty(0, dtype=np.int64)
+        self.peak_freqs = np.empty(0, dtype=np.float64)
+
+    def push(self, peak_times: np.ndarray, peak_freqs: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        peak_times: sorted, not earlier than the peaks of previous calls
+
+        returns `(hash_vals, anchor_times)` of the pairs whose target is one of the new peaks
+        """
+        n_previous = len(self.peak_times)
+        t = np.concatenate((self.peak_times, np.asarray(peak_times, dtype=np.int64)))
+        f = np.concatenate((self.peak_freqs, np.asarray(peak_freqs, dtype=np.float64)))
+        quantized_freqs = quantize_frequencies(f, self.sr)
+
+        # anchors of target j: the peaks in [t - fanout_t, t - 2], the reverse of
+        # the target zone (t + 1, t + fanout_t] of create_hash_arrays()
+        targets = np.arange(n_previous, len(t))
+        zone_start = np.searchsorted(t, t[targets] - self.fanout_t, side="left")
+        zone_end = np.searchsorted(t, t[targets] - 1, side="left")
+        zone_sizes = zone_end - zone_start
+
+        targets = np.repeat(targets, zone_sizes)
+        anchors = np.repeat(zone_start, zone_sizes) + (
+            np.arange(len(targets)) - np.repeat(np.cumsum(zone_sizes) - zone_sizes, zone_sizes)
+        )
+        in_zone = np.abs(f[targets] - f[anchors]) < self.fanout_f
+        anchors, targets = anchors[in_zone], targets[in_zone]
+
+        deltaT = (t[targets] - t[anchors]).astype(np.uint32)
+        hash_vals = quantized_freqs[anchors] | (quantized_freqs[targets] << 10) | (deltaT << 20)
+        anchor_times = t[anchors].astype(np.int32)
+
+        # peaks more than fanout_t frames before the latest one are no longer anchors
+        recent = t >= t[-1] - self.fanout_t if len(t) else np.ones(0, dtype=bool)
+        self.peak_times, self.peak_freqs = t[recent], f[recent]
+        return hash_vals, anchor_times
+
+
+def stream_hashes(peak_chunks, sr: int) -> tuple[np.ndarray, np.ndarray]:
     """
-    fanout:
-        specify the fan-out factor used for determining the target zone
+    peak_chunks: `(peak_times, peak_freqs)` chunks in time order,
+    e.g. from `const_map.stream_constellation_map()`
 
-        = number of timesteps forward from anchor to use for target points
+    returns the fingerprints `(hash_vals, anchor_times)` of every chunk, the same
+    (anchor, target) pairs as `create_hashes()` of all the peaks, in a different order.
+    Only the peaks of the last `fanout_t` frames are kept while hashing
     """
-    # Use a dictionary to store the fingerprints
-    # Dictionary structure: {hash: (time, song_id)}
-    # Dictionaries store key, value pairs allowing for fast lookup based on the key (hash)
-    fingerprints = {}
-    from parameters import read_parameters
-    fanout_t, fanout_f = read_parameters("hashing")
-    # TODO: The loop is implemeted for you but try to understand the intuition behind it yourself
-
-    # iterate through each anchor point in the constellation map
-    for i, anchor in enumerate(peaks):
-        # iterate through each point in target zone for that anchor point
-        for j in range(i+1, len(peaks)):
-            # TODO: select targets to compare to from a zone in front of the anchor point
-            # get the time and frequency difference as well
-            target = peaks[j]
-            time_diff = target[0] - anchor[0]
-            freq_diff = target[1] - anchor[1]
-
-            # determine if peak is within target zone
-            if time_diff <= 1:
-                continue
-            if np.abs(freq_diff) >= fanout_f:
-                continue
-            if time_diff > fanout_t:
-                # constellation points are sorted by time
-                # => no need to check more potential targets
-                break
-            
-            address = create_address(anchor, target, sr)
-
-            # TODO: store the hash in our frequencies dictrionary
-            # Hint: use the address as the key, and (time, song_id) as the value
-            anchorT = anchor[0]
-
-            fingerprints[address] = (int(anchorT), song_id)
-
-    return fingerprints
\ No newline at end of file
+    hasher = StreamingHasher(sr)
+    hash_vals, anchor_times = [np.empty(0, dtype=np.uint32)], [np.empty(0, dtype=np.int32)]
+    for peak_times, peak_freqs in peak_chunks:
+        chunk_hash_vals, chunk_anchor_times = hasher.push(peak_times, peak_freqs)
+        hash_vals.append(chunk_hash_vals.astype(np.uint32))
+        anchor_times.append(chunk_anchor_times)
+    return np.concatenate(hash_vals), np.concatenate(anchor_times)
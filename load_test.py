@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+# usage (with the server running, e.g. `python predict_song.py --production`):
+#   python load_test.py                                   8 clients, 100 requests
+#   python load_test.py --clients 32 --requests 500
+#   python load_test.py --url http://localhost:5003/predict --audio audio_samples/sample.wav
+#
+# every request uploads one of the audio files to /predict, the summary shows
+# throughput, latency percentiles of successful requests and the status codes
+# (503: rejected by the server's admission control)
+
+default_url = "http://localhost:5003/predict"
+audio_extensions = (".wav", ".flac", ".mp3", ".ogg", ".webm")
+
+
+def list_audio_files(audio_dir: str = "audio_samples") -> list[str]:
+    return sorted(
+        os.path.join(audio_dir, name) for name in os.listdir(audio_dir)
+        if name.lower().endswith(audio_extensions)
+    )
+
+
+def send_request(url: str, audio_path: str, audio_bytes: bytes) -> tuple[int, float, dict|None]:
+    """
+    returns `(status_code, seconds, json_body)`, status 0 if the request failed
+    """
+    start = time.perf_counter()
+    try:
+        files = {'audio': (os.path.basename(audio_path), audio_bytes)}
+        response = requests.post(url, files=files, timeout=120)
+        status = response.status_code
+        body = response.json() if status == 200 else None
+    except (requests.RequestException, ValueError):
+        status, body = 0, None
+    return status, time.perf_counter() - start, body
+
+
+def run_load_test(url: str = default_url, audio_paths: list[str] = None,
+                  n_clients: int = 8, n_requests: int = 100) -> dict:
+    """
+    sends `n_requests` uploads to `url` from `n_clients` concurrent clients
+    (cycling through `audio_paths`, default every file in audio_samples/)
+
+    returns
+    ```
+    {"seconds": ..., "requests_per_s": ..., "status_counts": {200: ..., 503: ...},
+     "latency_ms": {"p50": ..., "p90": ..., "p99": ..., "max": ...}}
+    ```
+    """
+    audio_paths = audio_paths or list_audio_files()
+    uploads = []
+    for audio_path in audio_paths:
+        with open(audio_path, "rb") as f:
+            uploads.append((audio_path, f.read()))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_clients) as clients:
+        results = list(clients.map(
+            lambda i: send_request(url, *uploads[i % len(uploads)]),
+            range(n_requests)
+        ))
+    seconds = time.perf_counter() - start
+
+    status_counts = {}
+    for status, _, _ in results:
+        status_counts[status] = status_counts.get(status, 0) + 1
+    latencies = np.array([latency for status, latency, _ in results if status == 200]) * 1e3
+    percentiles = {
+        f"p{q}": float(np.percentile(latencies, q)) if len(latencies) else None
+        for q in (50, 90, 99)
+    }
+    percentiles["max"] = float(latencies.max()) if len(latencies) else None
+    return {
+        "seconds": seconds,
+        "requests_per_s": n_requests / seconds,
+        "status_counts": status_counts,
+        "latency_ms": percentiles,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="drive /predict with concurrent uploads")
+    parser.add_argument("--url", default=default_url)
+    parser.add_argument("--audio", nargs="*", help="files to upload (default: audio_samples/)")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100)
+    args = parser.parse_args()
+
+    summary = run_load_test(args.url, args.audio, args.clients, args.requests)
+    print(f"{args.requests} requests from {args.clients} clients in {summary['seconds']:.2f} s "
+          f"({summary['requests_per_s']:.1f} requests/s)")
+    print("status codes:", ", ".join(f"{status}: {count}" for status, count in sorted(summary["status_counts"].items())))
+    latency = summary["latency_ms"]
+    if latency["p50"] is not None:
+        print(f"latency (200 only): p50 {latency['p50']:.0f} ms  p90 {latency['p90']:.0f} ms  "
+              f"p99 {latency['p99']:.0f} ms  max {latency['max']:.0f} ms")
+    sys.exit(0 if summary["status_counts"].get(200) else 1)
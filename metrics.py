@@ -0,0 +1,268 @@
+import time
+import bisect
+import functools
+import threading
+import contextlib
+
+# per-stage wall time and counts of the recognition pipeline
+#
+# ```
+# with metrics.record() as stats:          # one request
+#     scores = recognize_music(...)        # stages call metrics.timed() / metrics.count()
+# stats.as_dict()
+# # {"stages_ms": {"decode": ..., "compute_stft": ..., ..., "total": ...},
+# #  "counts": {"peaks": ..., "hashes": ..., "postings": ..., "songs_scored": ...}}
+# ```
+#
+# stages measure nothing unless the thread is inside record(), so the instrumented
+# functions cost one thread-local lookup per stage otherwise.
+# A stage's time excludes the stages nested in it (find_peaks does not include
+# remove_duplicate_peaks), so the stages of a request add up to at most its total
+
+# aggregate the stats of every recorded request into histograms (see snapshot(), /metrics).
+# False: only requests that ask for their stats (record(force=True)) are measured
+enabled = False
+
+# upper bounds of the histogram buckets, the last bucket holds larger values
+time_buckets_ms = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+count_buckets = (0, 10, 100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+_local = threading.local()
+_null_timer = contextlib.nullcontext()
+
+
+class RequestStats:
+    """
+    wall time (ms) spent in each stage and counts of one request,
+    a stage run several times (e.g. chunk by chunk) adds up
+    """
+
+    __slots__ = ("stages_ms", "counts", "nested_ms")
+
+    def __init__(self):
+        self.stages_ms = {}
+        self.counts = {}
+        # time of the stages nested in the one running, see _Timer
+        self.nested_ms = 0.0
+
+    def add_time(self, stage: str, ms: float) -> None:
+        self.stages_ms[stage] = self.stages_ms.get(stage, 0.0) + ms
+
+    def add_count(self, name: str, n: int) -> None:
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def merge(self, other: "RequestStats") -> None:
+        for stage, ms in other.stages_ms.items():
+            self.add_time(stage, ms)
+        for name, n in other.counts.items():
+            self.add_count(name, n)
+
+    def as_dict(self) -> dict:
+        return {
+            "stages_ms": {stage: round(ms, 3) for stage, ms in self.stages_ms.items()},
+            "counts": dict(self.counts),
+        }
+
+
+class _Timer:
+    __slots__ = ("stats", "stage", "start", "outer_nested_ms")
+
+    def __init__(self, stats: RequestStats, stage: str):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.outer_nested_ms = self.stats.nested_ms
+        self.stats.nested_ms = 0.0
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        ms = (time.perf_counter() - self.start) * 1e3
+        self.stats.add_time(self.stage, ms - self.stats.nested_ms)
+        self.stats.nested_ms = self.outer_nested_ms + ms
+
+
+def current() -> RequestStats|None:
+    """
+    stats of the request this thread is recording, `None` outside `record()`
+    """
+    return getattr(_local, "stats", None)
+
+
+def timed(stage: str):
+    """
+    context manager adding the wall time of its block to `stage`
+
+    ```
+    with metrics.timed("compute_stft"):
+        frequencies, times, magnitude = compute_stft(audio, sr)
+    ```
+    """
+    stats = getattr(_local, "stats", None)
+    if stats is None:
+        return _null_timer
+    return _Timer(stats, stage)
+
+
+def stage(name: str):
+    """
+    decorator timing every call of a function as the stage `name`, see `timed()`
+
+    ```
+    @metrics.stage("compute_stft")
+    def compute_stft(audio, sr, ...):
+    ```
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def timed_fn(*args, **kwargs):
+            stats = getattr(_local, "stats", None)
+            if stats is None:
+                return fn(*args, **kwargs)
+            with _Timer(stats, name):
+                return fn(*args, **kwargs)
+        return timed_fn
+    return decorator
+
+
+def count(name: str, n: int) -> None:
+    """
+    adds `n` to the counter `name` of the request being recorded
+    """
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats.add_count(name, int(n))
+
+
+@contextlib.contextmanager
+def record(force: bool = False):
+    """
+    measures the stages this thread runs inside the block, yields their `RequestStats`
+    (the `total` stage is the time of the whole block, added on exit)
+
+    yields `None` and measures nothing unless `enabled` or `force` is set,
+    the stats are added to the histograms only when `enabled`
+    """
+    if not (enabled or force):
+        yield None
+        return
+    stats, previous = RequestStats(), current()
+    _local.stats = stats
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.add_time("total", (time.perf_counter() - start) * 1e3)
+        _local.stats = previous
+        if enabled:
+            _aggregate(stats)
+
+
+def collect(fn, *args, **kwargs) -> tuple[object, RequestStats]:
+    """
+    returns `fn(*args, **kwargs)` and the stats of the stages it ran, for work done in
+    another process (see `predict_song.run_in_recognition_process()`), add them to the
+    request with `merge()`
+    """
+    stats, previous = RequestStats(), current()
+    _local.stats = stats
+    try:
+        return fn(*args, **kwargs), stats
+    finally:
+        _local.stats = previous
+
+
+def merge(stats: RequestStats) -> None:
+    """
+    adds `stats` (from `collect()`) to the request being recorded
+    """
+    if current() is not None:
+        current().merge(stats)
+
+
+class Histogram:
+    """
+    number of observed values in each bucket `(bounds[i - 1], bounds[i]]`, and their sum
+    """
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.bucket_counts = [0] * (len(bounds) + 1)
+        self.n = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.n += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float|None:
+        """
+        upper bound of the bucket holding the `q` quantile (None: above the last bound)
+        """
+        rank, seen = q * self.n, 0
+        for bound, n in zip(self.bounds, self.bucket_counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.n,
+            "mean": self.sum / self.n if self.n else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            # [upper bound, count] pairs, None: no upper bound
+            "buckets": [[bound, n] for bound, n in zip(self.bounds + (None,), self.bucket_counts)],
+        }
+
+
+_histograms = {"stages_ms": {}, "counts": {}}
+_n_requests = 0
+_lock = threading.Lock()
+
+
+def _aggregate(stats: RequestStats) -> None:
+    global _n_requests
+    with _lock:
+        _n_requests += 1
+        for kind, values, bounds in (("stages_ms", stats.stages_ms, time_buckets_ms),
+                                     ("counts", stats.counts, count_buckets)):
+            histograms = _histograms[kind]
+            for name, value in values.items():
+                if name not in histograms:
+                    histograms[name] = Histogram(bounds)
+                histograms[name].observe(value)
+
+
+def snapshot() -> dict:
+    """
+    histograms of the stage times and counts of every request recorded since the last `reset()`
+
+    ```
+    {"enabled": True, "requests": 120,
+     "stages_ms": {"compute_stft": {"count": 120, "mean": 4.1, "p50": 5, "p90": 5, "p99": 10,
+                                    "buckets": [[0.1, 0], ..., [None, 0]]}, ...},
+     "counts": {"hashes": {...}, ...}}
+    ```
+    """
+    with _lock:
+        return {
+            "enabled": enabled,
+            "requests": _n_requests,
+            **{kind: {name: histogram.as_dict() for name, histogram in sorted(histograms.items())}
+               for kind, histograms in _histograms.items()},
+        }
+
+
+def reset() -> None:
+    """
+    forgets the aggregated histograms
+    """
+    global _n_requests
+    with _lock:
+        _n_requests = 0
+        for histograms in _histograms.values():
+            histograms.clear()
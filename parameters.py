@@ -15,7 +15,10 @@ def set_parameters(
         candidates_per_band=6,
         bands=[(0,10),(10,20),(20,40),(40,80),(80,160),(160,512)],
         fanout_t=100,
-        fanout_f=1500
+        fanout_f=1500,
+        delta_time=10,
+        delta_freq=300,
+        lookahead=15
         ):
     """
     Used by `grid_search.py` to search for optimal parameters
@@ -29,6 +32,11 @@ def set_parameters(
         "hashing": {
             "fanout_t": fanout_t,
             "fanout_f": fanout_f
+        },
+        "duplicate_removal": {
+            "delta_time": delta_time,
+            "delta_freq": delta_freq,
+            "lookahead": lookahead
         }
     }
     with open(parameters_json, "w", encoding="utf-8") as f:
@@ -45,6 +53,9 @@ def read_parameters(paramset: str = "all_parameters"):
     # hasher.py
     fanout_t, fanout_f = read_parameters("hashing")
 
+    # const_map.py:remove_duplicate_peaks()
+    delta_time, delta_freq, lookahead = read_parameters("duplicate_removal")
+
     # all
     returns dict containing all parameters
 
@@ -67,6 +78,11 @@ def read_parameters(paramset: str = "all_parameters"):
         h = params.get("hashing", {})
         return h.get("fanout_t"), h.get("fanout_f")
 
+    if paramset == "duplicate_removal":
+        # parameters.json files written before this section existed use the old hard-coded thresholds
+        d = params.get("duplicate_removal", {})
+        return d.get("delta_time", 10), d.get("delta_freq", 300), d.get("lookahead", 15)
+
     if paramset == "all_parameters":
         return params
 
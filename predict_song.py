@@ -1,47 +1,93 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, json
 from flask_cors import CORS
 import numpy as np
-from search import recognize_music
+from search import score_hashes_cached, QueryBatcher
+from cm_helper import decode_audio_bytes
 import DBcontrol as db
 from DBcontrol import init_db
 import DB_adder as dba
+import fingerprint_index
+import metrics
+from streaming import StreamingRecognizer
 
 import tempfile
 import os
-import subprocess
+import sys
+import shutil
+import time
+import functools
+import threading
 import requests
 import yt_dlp
-import ffmpeg
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 app = Flask(__name__)
 CORS(app)
 
 library = "sql/library.db"
-idx = 0
+
+# where recognize_music() looks up hashes (see fingerprint_index.py):
+#   "memory": load the hashes table into memory at startup
+#   "mmap":   map the files written by fingerprint_index.export_mmap_index(),
+#             shared between worker processes through the page cache
+#   None:     query SQLite
+index_mode = "memory"
+
+# number of matches listed in prediction responses (`top_k` query parameter)
+response_top_k = 1
+
+# raw PCM sample formats accepted by /predict_stream (little-endian, mono)
+pcm_formats = {"f32": np.dtype("<f4"), "s16": np.dtype("<i2")}
+# bytes read from the request body per recognizer step
+stream_chunk_bytes = 16384
+# /predict_stream stops reading (and answers with the scores so far) after this much audio
+max_stream_seconds = 60
+
+# production serving (see serve()): recognition runs in `n_workers` pre-warmed processes
+# (None: one per CPU core). At most `max_pending_requests` recognition requests are
+# accepted at once (running or waiting for a worker), the others are answered with 503
+n_workers = None
+max_pending_requests = 16
+# `index_mode` of serve(): the mmap index is exported once by the server and shared by
+# the recognition processes through the page cache ("memory" loads a copy in each of them)
+serve_index_mode = "mmap"
+recognition_pool = None
+# held while the recognition processes are replaced (see restart_recognition_pool())
+# and while /add makes a new song visible to them (see publish_index())
+recognition_pool_lock = threading.RLock()
+# start method of the recognition processes. Not fork: the server is multi-threaded
+# (request threads, the query batcher, pooled SQLite connections), and a forked process
+# copies the locks those threads hold without the threads that would release them
+worker_start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+request_slots = None
+# concurrent requests look up their hashes in batches (see search.QueryBatcher), started by
+# serve(). None: only when hashes are looked up in SQLite (`serve_index_mode = None`); an in-memory
+# lookup costs less than scoring in the server instead of the recognition processes
+batch_queries = None
+query_batcher = None
 
 # provided file for downloading audio from youtube
 file_format = 'flac'
 def download_audio(youtube_url: str) -> str:
     
-    global idx
+    # each download gets its own directory, so concurrent requests never share file names
+    download_dir = tempfile.mkdtemp(prefix='download_')
     ydl_opts = {
         'format': 'bestaudio/best',
         'cookiefile': 'cookies.txt',
-        'outtmpl': f'output_{idx}.%(ext)s',
+        'outtmpl': os.path.join(download_dir, 'audio.%(ext)s'),
         'postprocessors': [{
             'key': 'FFmpegExtractAudio',
             'preferredcodec': file_format,
         }],
     }
-    idx += 1
 
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         ydl.download([youtube_url])
-        audio_path = f'output_{idx-1}.{file_format}'
-        stream = ffmpeg.input(f'output_{idx-1}.m4a')
-        stream = ffmpeg.output(stream, audio_path)
         
-    return audio_path
+    return os.path.join(download_dir, f'audio.{file_format}')
 
 def get_yt_metadata(youtube_url: str, audio_path: str) -> dict:
     track_data = {}
@@ -55,12 +101,232 @@ def get_yt_metadata(youtube_url: str, audio_path: str) -> dict:
     track_data["audio_path"] = audio_path
     return track_data
 
+def init_recognition_worker(database: str, mode: str|None, index_dir: str) -> None:
+    """
+    runs once in each recognition process: opens the fingerprint index and
+    warms up the pipeline, so the first request does not pay for it
+
+    the processes are not forked (see `worker_start_method`), each one loads the index:
+    a copy of the memory index per process, the mmap index is shared through the page cache
+    """
+    from cm_helper import add_noise
+    from const_map import create_constellation_map
+    from hasher import create_hashes
+    from search import score_hashes
+
+    db.library = database
+    fingerprint_index.mmap_index_dir = index_dir
+    if fingerprint_index.index is None:
+        if mode == "memory":
+            fingerprint_index.load_memory_index()
+        elif mode == "mmap":
+            fingerprint_index.load_mmap_index()
+
+    sr = 11025
+    noise = add_noise(np.zeros(2 * sr, dtype=np.float32), 1.0)
+    score_hashes(create_hashes(create_constellation_map(noise, sr), sr), index=fingerprint_index.index)
+
+def fingerprint_upload(data: bytes) -> tuple[np.ndarray, np.ndarray]:
+    """
+    decodes an uploaded audio file held in memory and returns its hashes,
+    what a recognition process sends back when lookups are batched
+    """
+    from const_map import create_constellation_map
+    from hasher import create_hashes
+
+    sample, sr = decode_audio_bytes(data)
+    return create_hashes(create_constellation_map(sample, sr), sr)
+
+def recognize_upload(data: bytes, top_k: int = None) -> list[tuple[int, int]]:
+    """
+    decodes an uploaded audio file held in memory and returns the `recognize_music()` scores,
+    what a recognition process sends back
+
+    a clip (nearly) identical to a recent one is answered from the result cache
+    of this process (see `search.score_hashes_cached()`)
+    """
+    return score_hashes_cached(fingerprint_upload(data), fingerprint_index.index)[:top_k]
+
+def start_recognition_pool(n: int = None) -> ProcessPoolExecutor:
+    """
+    starts `n` (default `n_workers`) recognition processes and waits until they are warmed up
+    """
+    n = n or n_workers or os.cpu_count()
+    pool = ProcessPoolExecutor(max_workers=n, mp_context=multiprocessing.get_context(worker_start_method),
+                               initializer=init_recognition_worker,
+                               initargs=(db.library, index_mode, fingerprint_index.mmap_index_dir))
+    # each submit starts a process while none is idle,
+    # a process whose initializer failed breaks the pool and fails them
+    for future in wait([pool.submit(os.getpid) for _ in range(n)]).done:
+        future.result()
+    return pool
+
+def restart_recognition_pool(broken: ProcessPoolExecutor = None) -> None:
+    """
+    replaces the recognition processes, so they open the index again (see `publish_index()`).
+    Requests already submitted finish in the old processes, concurrent calls
+    restart one after the other
+
+    `broken`: replace the pool only if it still is `broken` (not already replaced
+    by another request that found it broken)
+    """
+    global recognition_pool
+    with recognition_pool_lock:
+        if recognition_pool is None or (broken is not None and recognition_pool is not broken):
+            return
+        old_pool = recognition_pool
+        recognition_pool = start_recognition_pool(old_pool._max_workers)
+        old_pool.shutdown(wait=False)
+
+def publish_index() -> None:
+    """
+    makes the songs added to this process's index (by `DB_adder.add_song()`) visible to
+    the recognition processes:
+    - "mmap": the index is exported again and reopened here (without the songs held
+      in memory, they are in the files now), then the processes are restarted to map it
+    - "memory": the processes are restarted and each one loads the hashes table again
+    - None: nothing to do, the processes query SQLite
+    """
+    if recognition_pool is None or index_mode is None:
+        return
+    with recognition_pool_lock:
+        if index_mode == "mmap":
+            fingerprint_index.export_mmap_index()
+            fingerprint_index.load_mmap_index()
+        restart_recognition_pool()
+
+def submit_recognition(fn, *args):
+    """
+    `recognition_pool.submit(fn, *args)`, to the new pool if `restart_recognition_pool()`
+    shut down the one read meanwhile, or after replacing a broken pool
+    """
+    pool = recognition_pool
+    try:
+        return pool.submit(fn, *args)
+    except BrokenProcessPool:
+        # a process died (killed for its memory, a crashing decoder), the pool
+        # refuses every request until it is replaced
+        restart_recognition_pool(broken=pool)
+    except RuntimeError:
+        # cannot schedule new futures after shutdown
+        pass
+    with recognition_pool_lock:
+        return recognition_pool.submit(fn, *args)
+
+def run_recognition(data: bytes, top_k: int = None) -> list[tuple[int, int]]:
+    """
+    decodes and scores the upload in a recognition process (production mode) or in this thread
+
+    with `query_batcher`, the processes only fingerprint the upload and the lookup
+    is batched with those of concurrent requests, then scored in this thread
+    """
+    if query_batcher is not None:
+        if recognition_pool is None:
+            hashes = fingerprint_upload(data)
+        else:
+            hashes = run_in_recognition_process(fingerprint_upload, data)
+        return query_batcher.score(hashes, top_k)
+    if recognition_pool is None:
+        return recognize_upload(data, top_k)
+    return run_in_recognition_process(recognize_upload, data, top_k)
+
+def run_in_recognition_process(fn, *args):
+    """
+    returns `fn(*args)` computed by a recognition process. When the request is being
+    measured, the stages timed in the process are added to its stats, and the rest of
+    the wait (queueing for a free process, sending arguments and results) as `recognition_pool`
+    """
+    if metrics.current() is None:
+        return submit_recognition(fn, *args).result()
+    start = time.perf_counter()
+    result, stats = submit_recognition(metrics.collect, fn, *args).result()
+    metrics.merge(stats)
+    pool_ms = (time.perf_counter() - start) * 1e3 - sum(stats.stages_ms.values())
+    metrics.current().add_time('recognition_pool', pool_ms)
+    return result
+
+def admission_control(view):
+    """
+    answers 503 instead of queueing once `max_pending_requests` requests are in progress
+    (production mode), so a traffic burst cannot pile up unbounded work and latency
+    """
+    @functools.wraps(view)
+    def bounded_view(*args, **kwargs):
+        if request_slots is None:
+            return view(*args, **kwargs)
+        if not request_slots.acquire(blocking=False):
+            return jsonify({'error': 'server busy, retry later'}), 503, {'Retry-After': '1'}
+        try:
+            return view(*args, **kwargs)
+        finally:
+            request_slots.release()
+    return bounded_view
+
+def measured(view):
+    """
+    measures the stages of the request (see metrics.py) when `metrics.enabled` is set or
+    the request asks for them with the `debug=1` query parameter, which adds them to the
+    JSON response under `debug`
+    """
+    @functools.wraps(view)
+    def measured_view(*args, **kwargs):
+        debug = request.args.get('debug', 0, type=int)
+        with metrics.record(force=bool(debug)) as stats:
+            response = app.make_response(view(*args, **kwargs))
+        if debug and response.is_json:
+            body = response.get_json()
+            body['debug'] = stats.as_dict()
+            response.set_data(json.dumps(body))
+        return response
+    return measured_view
+
+def prediction_response(scores: list[tuple[int, int]], top_k: int = None) -> dict|None:
+    """
+    JSON body of /predict and /predict_stream: the best match, and the `top_k`
+    (default `response_top_k`) best ones under `matches`,
+    `None` when none of the scored songs is in the library (anymore)
+
+    only the metadata of the returned songs is fetched, with one query
+    (or none, see `DBcontrol.retrieve_songs()`), songs without a row are skipped
+    and the next best ones fetched in their place
+    """
+    top_k = top_k or response_top_k
+    matches, start = [], 0
+    while len(matches) < top_k and start < len(scores):
+        candidates = scores[start:start + top_k - len(matches)]
+        start += len(candidates)
+        songs = db.retrieve_songs(song_id for song_id, _ in candidates)
+        matches += [
+            {
+                'song_id': int(song_id),
+                'confidence': float(score),
+                'url': songs[song_id]["youtube_url"],
+                'title': songs[song_id]["title"]
+            }
+            for song_id, score in candidates if song_id in songs
+        ]
+    if not matches:
+        return None
+    return {
+        'best': matches[0]['song_id'],
+        'confidence': matches[0]['confidence'],
+        'urls': matches[0]['url'],
+        'titles': matches[0]['title'],
+        'matches': matches
+    }
+
 @app.route('/predict', methods=['POST'])
+@admission_control
+@measured
 def predict():
     """
     Predict the song from the uploaded audio file.
     This endpoint accepts a POST request with an audio file (PyDub AudioSegment) and returns
     the predicted song information in JSON format.
+
+    Optional query parameters: `top_k`, number of matches listed in the response,
+    and `debug=1`, which adds the time spent in each stage and counts of peaks, hashes,
+    postings and songs scored (see metrics.py).
     """
     
     # get audio from the request
@@ -69,59 +335,73 @@ def predict():
         return jsonify({'error': 'No audio found'})
     
     audio_file = request.files['audio']
+    top_k = request.args.get('top_k', response_top_k, type=int)
     
-    print(audio_file.path)
-    
-    # if not already a wav file then convert to wav
-    if audio_file.filename.endswith('.webm'):
-        # Create a temporary file for the webm conversion
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.webm') as temp_webm:
-            audio_file.save(temp_webm.name)
-            temp_webm_path = temp_webm.name
-    
-    # Convert to WAV using FFmpeg
-    temp_audio_path = temp_webm_path.replace('.webm', '.wav')
-    
-    #print(f"Converting {temp_webm_path} to {temp__path}")
-    
-    subprocess.run([
-         'ffmpeg', '-i', temp_webm_path,
-         '-ar', '44100',  # Sample rate
-         '-ac', '1',      # Mono
-         '-y',            # Overwrite
-         temp_audio_path
-     ], check=True, capture_output=True)
-    
-    # Use scipy to parse the WAV file properly
-    #sample_rate, audio_array = wavfile.read(temp_audio_path)
-    # Convert to float32 and normalize
-    #audio_array = audio_array.astype(np.float32) / (2**15)
-    #print(f"Audio loaded: {len(audio_array)} samples at {sample_rate}Hz")
-
-    # change this to a custom file path to test other files
-    #scores, _ = recognize_music("./tracks/audio/" + audio_file.filename)
-    scores, _ = recognize_music(audio_file.filename)
-
-    # audio = "./tracks/audio/TylerTheCreator_DOGTOOTH_QdkbuXIJHfk.flac"
-    audio = "./audio_samples/Dogtooth_rec.flac"
-    print(recognize_music(audio))
-
-    urls = []
-    names = []
-    for id in scores:
-        urls.append(db.retrieve_song(id[0])["youtube_url"])
-        names.append(db.retrieve_song(id[0])["title"])
-
-    # this line will be necessary for recorded files but not right now
-    os.remove("temp_audio_path")
+    # the upload (usually webm from the browser) is decoded from memory straight to
+    # 11025 Hz mono, without temporary files (see cm_helper.decode_audio_bytes())
+    # every score is kept, prediction_response() skips songs that were removed
+    # from the library and lists the next best ones
+    try:
+        scores = run_recognition(audio_file.read())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    response = prediction_response(scores, top_k) if scores else None
+    if response is None:
+        return jsonify({'error': 'No match found'})
     
     # return the best prediction in a JSON object
-    return jsonify({
-        'best': scores[0][0],
-        'confidence': float(scores[0][1]),
-        'urls': urls[0],
-        'titles': names[0]
-    })
+    return jsonify(response)
+
+@app.route('/predict_stream', methods=['POST'])
+@admission_control
+@measured
+def predict_stream():
+    """
+    Predict the song from raw mono PCM audio streamed in the request body
+    (e.g. a chunked upload from a microphone). The audio is fingerprinted and scored
+    as it arrives, and the answer is sent as soon as one song is clearly ahead,
+    without waiting for the rest of the upload. At most `max_stream_seconds` of audio are read.
+
+    Query parameters: `sr` (sampling rate, default 44100),
+    `format` ("f32", the default, or "s16"), `top_k` and `debug` (as /predict).
+    Returns the same JSON as /predict, plus the seconds of audio that were needed.
+    """
+    sr = request.args.get('sr', 44100, type=int)
+    dtype = pcm_formats.get(request.args.get('format', 'f32'))
+    if dtype is None or not sr or sr <= 0:
+        return jsonify({'error': 'unsupported sr or format'}), 400
+
+    recognizer = StreamingRecognizer(input_sr=sr)
+    remainder = b""
+    while chunk := request.stream.read(stream_chunk_bytes):
+        # a chunk can end in the middle of a sample, keep those bytes for the next one
+        data = remainder + chunk
+        n_bytes = len(data) - len(data) % dtype.itemsize
+        remainder = data[n_bytes:]
+        audio = np.frombuffer(data[:n_bytes], dtype=dtype).astype(np.float32)
+        if dtype.kind == 'i':
+            audio /= 2**15
+        if recognizer.push(audio) is not None or recognizer.seconds >= max_stream_seconds:
+            break
+
+    # the rest of the buffered audio is scored too, and reported if nothing matched earlier
+    scores = recognizer.finish()
+    if scores and recognizer.match is not None:
+        scores = [recognizer.match] + [score for score in scores if score[0] != recognizer.match[0]]
+    response = prediction_response(scores, request.args.get('top_k', response_top_k, type=int)) if scores else None
+    if response is None:
+        return jsonify({'error': 'No match found', 'seconds': recognizer.seconds})
+    response['seconds'] = recognizer.seconds
+    return jsonify(response)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    histograms of the stage times and counts of the requests measured since the server
+    started (with `metrics.enabled`, e.g. `python predict_song.py --production --metrics`)
+    """
+    return jsonify(metrics.snapshot())
 
 @app.route('/add', methods=['POST']) 
 # TODO: add an endpoint (@app.route) for adding a song to the database
@@ -142,8 +422,8 @@ def add_song():
     #response = requests.post(url, files=files)  # <-- access filesdict via request.files
     #from flask import request
 
-    print(request.files)
-    youtube_url = request.files['youtube_url'][1]
+    # test_add_song.py sends the url as a form field: files={'youtube_url': (None, url, 'text/plain')}
+    youtube_url = request.form['youtube_url']
     
     # TODO: Check if the song already exists in the database using dba.check_if_song_exists
     # Implement this function in DB_adder.py if not already done
@@ -158,20 +438,65 @@ def add_song():
     
     # TODO: Add song to the database
     # Implement dba.add_song in DB_adder.py if not already done
-    song_id = dba.add_song(track_data)
+    # (under the lock, so no other song is added to this process's index
+    # between the export and reopening it, see publish_index())
+    with recognition_pool_lock:
+        song_id = dba.add_song(track_data)
+        publish_index()
     
     # Clean up temporary file
     # Note: we only need to keep the fingerprint representation,
     # not the actual audio file
-    os.remove(temp_audio_path)
+    shutil.rmtree(os.path.dirname(temp_audio_path), ignore_errors=True)
     
     # TODO: Return a json object with a success message and the new tracks's song_id
     return jsonify({'status': 'success', 'song_id': song_id})
             
 
+def load_index() -> None:
+    if index_mode == "memory":
+        fingerprint_index.load_memory_index()
+    elif index_mode == "mmap":
+        if not os.path.isdir(fingerprint_index.mmap_index_dir):
+            fingerprint_index.export_mmap_index()
+        fingerprint_index.load_mmap_index()
+
+def serve(host: str = '0.0.0.0', port: int = 5003) -> None:
+    """
+    production mode: a threaded server without the debugger and reloader, handing
+    recognition to a pool of pre-warmed processes (`n_workers`), with at most
+    `max_pending_requests` requests in progress and their lookups batched (`batch_queries`)
+
+    the index is `serve_index_mode`, an mmap index is exported from the database first,
+    so it holds every song added since the last export
+    """
+    global recognition_pool, request_slots, query_batcher, index_mode
+    index_mode = serve_index_mode
+    if index_mode == "mmap":
+        fingerprint_index.export_mmap_index()
+    load_index()
+    recognition_pool = start_recognition_pool()
+    request_slots = threading.BoundedSemaphore(max_pending_requests)
+    if batch_queries or (batch_queries is None and index_mode is None):
+        query_batcher = QueryBatcher()
+    try:
+        app.run(host=host, port=port, threaded=True, debug=False)
+    finally:
+        recognition_pool.shutdown()
+        if query_batcher is not None:
+            query_batcher.close()
+
 if __name__ == '__main__':
     # Initialize the database using our command for now
     #init_db(n_songs=4)
+
+    # python predict_song.py --production [--metrics]
+    if '--metrics' in sys.argv:
+        metrics.enabled = True
+    if '--production' in sys.argv:
+        serve()
+    else:
+        load_index()
     
-    # Run the Flask app at this given host and port
-    app.run(host='0.0.0.0', port=5003, debug=True)
+        # Run the Flask app at this given host and port
+        app.run(host='0.0.0.0', port=5003, debug=True)
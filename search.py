@@ -1,14 +1,163 @@
 import numpy as np
-import os
-from collections import defaultdict
+import time
+import heapq
+import queue
+import itertools
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import Future
 
 from hasher import create_hashes
 from cm_helper import preprocess_audio
 from const_map import create_constellation_map
-from DBcontrol import connect, retrieve_hashes
+import metrics
+import fingerprint_index
+import DBcontrol
+from DBcontrol import reader, retrieve_postings, retrieve_hash_df, count_songs
 
-def score_hashes(hashes: dict[int, tuple[int, int]]) -> tuple[list[tuple[int, int]], dict[int, set[int, int]]]:
+# progressive scoring (see score_hashes_progressive()):
+# sample hashes are matched `progressive_chunk_frames` STFT frames at a time (~2 s),
+# stopping once the leading song is `progressive_margin` points ahead of the runner-up
+progressive_chunk_frames = 16
+progressive_margin = 5
+
+# hashes found in many songs carry little information (see match_time_pairs()):
+# skip hashes found in more than `hash_max_df` songs (None: keep every hash),
+# weight votes by the inverse document frequency of their hash when `idf_weighting` is set
+hash_max_df = None
+idf_weighting = False
+
+# micro-batching of concurrent queries (see QueryBatcher): hashes submitted within
+# `query_batch_window_s` seconds of the first one are looked up together,
+# at most `max_query_batch` samples per lookup
+query_batch_window_s = 0.002
+max_query_batch = 32
+
+# scores of recent queries (see ResultCache, score_hashes_cached()): a sample whose set of
+# addresses is nearly the same as that of a query scored less than `result_cache_ttl_s`
+# seconds ago gets the same scores without a lookup. At most `result_cache_size` results
+# are kept, the cache is cleared when songs are added (DB_adder.add_song())
+result_cache_size = 1024
+result_cache_ttl_s = 600
+# number of hash functions in the MinHash signature of a sample (see minhash_signature())
+minhash_permutations = 32
+
+
+def match_time_pairs(hashes: tuple[np.ndarray, np.ndarray], index=None, cur=None,
+                     max_df: int = None, idf: bool = False) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray|None]:
+    """
+    looks up `hashes` in `index` (or with `cur`, by default a pooled read-only connection, when `index=None`)
+    and returns the distinct time pairs of the matches as arrays sorted by song:
+
+    ```
+    candidate_ids                # sorted song ids with at least one match
+    song_index[i]                # the i-th time pair belongs to candidate_ids[song_index[i]]
+    source_times[i], sample_times[i]
+    weights[i]                   # None unless idf=True
+    ```
+
+    `max_df`: ignore hashes found in more than `max_df` songs (None: use every hash)
+
+    `idf=True`: weight each time pair by the inverse document frequency of its hash,
+    `log(1 + n_songs / df)` (the largest, if the pair was found through several hashes)
     """
+    if index is None and cur is None:
+        # borrow a pooled read-only connection for the lookups
+        with reader() as con:
+            return match_time_pairs(hashes, index, con.cursor(), max_df, idf)
+
+    # the same address can occur at several times in the sample,
+    # sort the sample hashes so the times of each address are a contiguous slice
+    hash_vals, sample_times = hashes
+    order = np.argsort(hash_vals, kind="stable")
+    hash_vals = np.asarray(hash_vals, dtype=np.uint32)[order]
+    sample_times = np.asarray(sample_times, dtype=np.int64)[order]
+    use_df = max_df is not None or idf
+
+    # look up every sample hash in one batch (a handful of queries per sample)
+    # instead of one `retrieve_hashes(address, cur)` round-trip per hash.
+    # matches are returned as parallel arrays (hash_val, song_id, time_stamp)
+    with metrics.timed("lookup"):
+        if index is not None:
+            matching_hashes = index.lookup(hash_vals)
+            if use_df:
+                # the index returns every posting of a hash, so its document frequency
+                # is the number of distinct songs among them
+                df_hash_vals, df = postings_document_frequencies(*matching_hashes[:2])
+                n_songs = index.n_songs
+        else:
+            lookup_hash_vals = hash_vals
+            if use_df:
+                # skip common hashes before fetching their postings
+                df_hash_vals, df = retrieve_hash_df(hash_vals, cur)
+                n_songs = count_songs(cur) if idf else None
+                if max_df is not None:
+                    lookup_hash_vals = df_hash_vals[df <= max_df]
+            matching_hashes = retrieve_postings(lookup_hash_vals, cur)
+    match_hash_vals, match_song_ids, match_source_times = matching_hashes
+    metrics.count("postings", len(match_hash_vals))
+
+    if use_df:
+        match_df = np.maximum(df[np.searchsorted(df_hash_vals, match_hash_vals)], 1)
+        if max_df is not None:
+            keep = match_df <= max_df
+            match_hash_vals, match_song_ids, match_source_times, match_df = (
+                match_hash_vals[keep], match_song_ids[keep], match_source_times[keep], match_df[keep]
+            )
+
+    # pair every match with every sample time of its address
+    starts = np.searchsorted(hash_vals, match_hash_vals, side="left")
+    counts = np.searchsorted(hash_vals, match_hash_vals, side="right") - starts
+    song_ids = np.repeat(np.asarray(match_song_ids, dtype=np.int64), counts)
+    source_times = np.repeat(np.asarray(match_source_times, dtype=np.int64), counts)
+    sample_times = sample_times[fingerprint_index.expand_ranges(starts, counts)]
+
+    # each bin is a set: a (sourceT, sampleT) pair found through several addresses counts once.
+    # one integer key per (song, sourceT, sampleT), np.unique sorts the keys by song
+    candidate_ids, song_index = np.unique(song_ids, return_inverse=True)
+    n_source_times = int(source_times.max(initial=0)) + 1
+    n_sample_times = int(sample_times.max(initial=0)) + 1
+    keys = (song_index * n_source_times + source_times) * n_sample_times + sample_times
+    weights = None
+    if idf:
+        # smoothed, so a hash found in every song still counts a little (log 2)
+        weights = np.repeat(np.log1p(max(n_songs, 1) / match_df), counts)
+        # sort by key, then largest weight first, and keep the first entry of each key
+        order = np.lexsort((-weights, keys))
+        keys, weights = keys[order], weights[order]
+        first = np.flatnonzero(np.diff(keys, prepend=-1))
+        keys, weights = keys[first], weights[first]
+    else:
+        keys = np.unique(keys)
+    song_index, source_times = np.divmod(keys // n_sample_times, n_source_times)
+    sample_times = keys % n_sample_times
+
+    return candidate_ids, song_index, source_times, sample_times, weights
+
+
+def postings_document_frequencies(hash_vals: np.ndarray, song_ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    returns `(hash_vals, n_songs)`: the distinct hash values of a set of postings, sorted,
+    and the number of distinct songs among the postings of each
+    """
+    hash_song_pairs = np.unique((np.asarray(hash_vals, dtype=np.int64) << 32) | np.asarray(song_ids, dtype=np.int64))
+    return np.unique((hash_song_pairs >> 32).astype(np.uint32), return_counts=True)
+
+
+@metrics.stage("scoring")
+def score_hashes(hashes: tuple[np.ndarray, np.ndarray], index=None,
+                 max_df: int = None, idf: bool = None) -> tuple[list[tuple[int, int]], dict[int, set[int, int]]]:
+    """
+    hashes: `(hash_vals, sample_times)` arrays from `hasher.create_hashes()`
+
+    index: where to look up hashes, an object with a `lookup(hash_vals)` method
+    such as `fingerprint_index.MemoryIndex` or `MmapIndex`. `None` (default) queries the SQLite database
+
+    `max_df`, `idf`: skip / down-weight common hashes, see `match_time_pairs()`.
+    `None` (default) uses the module settings `hash_max_df`, `idf_weighting`.
+    With IDF weights, scores are sums of weights instead of counts
+
     returns two values:
 
     ```
@@ -17,9 +166,6 @@ def score_hashes(hashes: dict[int, tuple[int, int]]) -> tuple[list[tuple[int, in
     ```
     
     """
-    con = connect()
-    cur = con.cursor()
-
     # An Industrial-Strength Audio Search Algorithm
     # 2.3: Searching and Scoring
     
@@ -33,23 +179,10 @@ def score_hashes(hashes: dict[int, tuple[int, int]]) -> tuple[list[tuple[int, in
     # The time pairs are distributed into bins according to the 
     # track ID associated with the matching database hash
 
-    # TODO: Implement the steps above, storing source and sample time pairs in a 
-    # bin (dictionary) for each song.
-
-    time_pair_bins = defaultdict(set)
-    
-    for address, (sampleT, _) in hashes.items():
-        
-        # Hint: This line retrieves matchin hashes froom the database in the format
-        # (hash_val, time_stamp, song_id)
-        matching_hashes = retrieve_hashes(address, cur)
-        
-        # TODO: Finish the loop by adding (sourceT, sampleT) pairs to the appropriate bin
-        if matching_hashes is not None:
-            #print(matching_hashes)
-            #exit(0)
-            for _, sourceT, song_id in matching_hashes:
-                time_pair_bins[song_id].add((sourceT, sampleT))
+    max_df = hash_max_df if max_df is None else max_df
+    idf = idf_weighting if idf is None else idf
+    candidate_ids, song_index, source_times, sample_times, weights = match_time_pairs(hashes, index, None, max_df, idf)
+    time_pair_bins = TimePairBins(candidate_ids, song_index, source_times, sample_times)
             
     # After all sample hashes have been used to search in the
     # database to form matching time pairs, the bins are scanned
@@ -80,34 +213,443 @@ def score_hashes(hashes: dict[int, tuple[int, int]]) -> tuple[list[tuple[int, in
     # sourceT = sampleT + offset
     # => offset = sourceT - sampleT
 
-    scores = {}
-    for song_id, time_pair_bin in time_pair_bins.items():
-        # For each (sourceT, sampleT) coordinate in the scatterplot,
-        # we calculate:
-        # deltaT = sourceT - sampleT
-        deltaT_values = [sourceT - sampleT for (sourceT, sampleT) in time_pair_bin]
-
-        # Then we calculate a histogram of these deltaT values
-        # and scan for a peak.
-        #hist = defaultdict(lambda: 0)
-        #for dT in deltaT_values:
-            #hist[dT] += 1
-        hist, bin_edges = np.histogram(deltaT_values, bins=max(len(np.unique(deltaT_values)), 10))
-
-        # The score of the match is the number of matching points
-        # in the histogram peak
-        #scores[song_id] = max(hist.values()) if hist else 0
-        scores[song_id] = hist.max()
-
-    scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-    con.close()
+    # For each (sourceT, sampleT) coordinate in the scatterplot,
+    # we calculate:
+    # deltaT = sourceT - sampleT
+    deltaT_values = source_times - sample_times
+
+    # Then we count the points at each (song, deltaT), one histogram bin per
+    # deltaT value, for all songs at once (integer keys sorted by song, then deltaT)
+    deltaT_values -= deltaT_values.min(initial=0)
+    n_deltaT_values = int(deltaT_values.max(initial=0)) + 1
+    song_deltaT_keys, inverse, hist = np.unique(song_index * n_deltaT_values + deltaT_values,
+                                                return_inverse=True, return_counts=True)
+    if weights is not None:
+        hist = np.bincount(inverse, weights=weights, minlength=len(song_deltaT_keys))
+
+    # The score of the match is the number of matching points
+    # in the histogram peak of each song
+    song_index = song_deltaT_keys // n_deltaT_values
+    first_of_song = np.flatnonzero(np.diff(song_index, prepend=-1))
+    scores = np.maximum.reduceat(hist, first_of_song) if len(hist) else hist
+
+    order = np.argsort(-scores, kind="stable")
+    scores = list(zip(candidate_ids[order].tolist(), scores[order].tolist()))
+    metrics.count("songs_scored", len(scores))
     return scores, time_pair_bins
 
 
-def recognize_music(sample_audio_path: str, remove_sample: bool = True) -> list[tuple[int, int]]:
+@metrics.stage("scoring")
+def score_hashes_progressive(hashes: tuple[np.ndarray, np.ndarray], index=None,
+                             chunk_frames: int = None, margin: int = None, top_k: int = None,
+                             max_df: int = None, idf: bool = None) -> tuple[list[tuple[int, int]], "TimePairBins"]:
+    """
+    same inputs and outputs as `score_hashes()`, but the sample hashes are matched in
+    time order, `chunk_frames` STFT frames at a time, keeping a running offset histogram
+    for every song. Stops as soon as the leading song's score is `margin` points ahead of
+    the runner-up, so a clean sample is usually decided by its first chunks
+    and a hard one falls back to matching every hash
+
+    `chunk_frames=None`, `margin=None` (default) use `progressive_chunk_frames`, `progressive_margin`,
+    `max_df`, `idf` as in `score_hashes()`
+
+    returns the `top_k` best scores (all when `top_k=None`) and the time pairs of the chunks
+    that were matched
+    """
+    chunk_frames = chunk_frames or progressive_chunk_frames
+    margin = progressive_margin if margin is None else margin
+    max_df = hash_max_df if max_df is None else max_df
+    idf = idf_weighting if idf is None else idf
+
+    hash_vals, sample_times = hashes
+    order = np.argsort(sample_times, kind="stable")
+    hash_vals = np.asarray(hash_vals)[order]
+    sample_times = np.asarray(sample_times)[order]
+    chunk_starts = np.searchsorted(sample_times, np.arange(0, int(sample_times.max(initial=0)) + 1, chunk_frames))
+
+    histogram = OffsetHistogram(weighted=idf)
+
+    # there is at least one chunk, even for an empty sample
+    for start, end in zip(chunk_starts, np.append(chunk_starts[1:], len(hash_vals))):
+        chunk_ids, song_index, source_times, chunk_times, weights = match_time_pairs(
+            (hash_vals[start:end], sample_times[start:end]), index, None, max_df, idf
+        )
+        # chunks cover distinct sample times, so their time pairs never repeat
+        histogram.add(chunk_ids[song_index], source_times, chunk_times, weights, distinct=True)
+        if histogram.leader_margin() >= margin:
+            break
+
+    scores = histogram.scores()
+    metrics.count("songs_scored", len(scores))
+    return scores[:top_k], histogram.time_pair_bins()
+
+
+class OffsetHistogram:
+    """
+    the (song, deltaT) histogram of `score_hashes()`, for time pairs that arrive in batches
+    (see `score_hashes_progressive()`, `streaming.StreamingRecognizer`)
+
+    ```
+    histogram = OffsetHistogram()
+    histogram.add(song_ids, source_times, sample_times)
+    histogram.scores()  # [(top_song_id, top_song_score), ...]
+    ```
+
+    each `add()` costs time in proportion to the pairs it adds, not to every pair so far,
+    so a long stream of small batches stays linear:
+    the histogram and the peak of each song are dictionaries updated in place
+
+    `dedupe_window`: a promise that pairs added later have sample times at most
+    `dedupe_window` frames before the latest sample time added so far (true for hashes from
+    `hasher.StreamingHasher`, with its `fanout_t`). Repeated time pairs are then only looked
+    for among these recent pairs. `None` (default) compares with every pair added so far
+    """
+
+    def __init__(self, weighted: bool = False, dedupe_window: int = None):
+        self.weighted = weighted
+        self.dedupe_window = dedupe_window
+        # every time pair so far, one array per batch
+        self.song_id_chunks, self.source_time_chunks, self.sample_time_chunks = [], [], []
+        # pairs new ones are compared with to skip repeats (the recent ones with `dedupe_window`)
+        self.recent_pairs = np.empty((0, 2), dtype=np.int64)
+        self.recent_sample_times = np.empty(0, dtype=np.int64)
+        # {song_id << 32 | deltaT + 2**31: count (or summed weight)}
+        self.hist = {}
+        # {song_id: histogram peak}, peaks only grow since counts and weights are not negative
+        self.peaks = {}
+
+    def add(self, song_ids: np.ndarray, source_times: np.ndarray, sample_times: np.ndarray,
+            weights: np.ndarray = None, distinct: bool = False) -> None:
+        """
+        adds time pairs, those already added are skipped (a time pair counts once,
+        with the weight it was first added with) unless `distinct=True` promises there are none
+        """
+        song_ids = np.asarray(song_ids, dtype=np.int64)
+        source_times = np.asarray(source_times, dtype=np.int64)
+        sample_times = np.asarray(sample_times, dtype=np.int64)
+        if not distinct:
+            pairs = np.column_stack(((song_ids << 32) | source_times, sample_times))
+            n_recent = len(self.recent_pairs)
+            _, first = np.unique(np.concatenate((self.recent_pairs, pairs)), axis=0, return_index=True)
+            new = np.sort(first[first >= n_recent]) - n_recent
+            song_ids, source_times, sample_times = song_ids[new], source_times[new], sample_times[new]
+            weights = None if weights is None else np.asarray(weights)[new]
+            self.recent_pairs = np.concatenate((self.recent_pairs, pairs[new]))
+            self.recent_sample_times = np.concatenate((self.recent_sample_times, sample_times))
+            if self.dedupe_window is not None and len(self.recent_sample_times):
+                recent = self.recent_sample_times >= self.recent_sample_times.max() - self.dedupe_window
+                self.recent_pairs, self.recent_sample_times = self.recent_pairs[recent], self.recent_sample_times[recent]
+
+        self.song_id_chunks.append(song_ids)
+        self.source_time_chunks.append(source_times)
+        self.sample_time_chunks.append(sample_times)
+
+        # histogram of this batch, then merged into the running one
+        keys = (song_ids << 32) | (source_times - sample_times + 2**31)
+        batch_keys, inverse = np.unique(keys, return_inverse=True)
+        batch_hist = np.bincount(inverse, weights, minlength=len(batch_keys))
+        if not self.weighted:
+            batch_hist = batch_hist.astype(np.int64)
+        hist, peaks = self.hist, self.peaks
+        for key, value in zip(batch_keys.tolist(), batch_hist.tolist()):
+            value += hist.get(key, 0)
+            hist[key] = value
+            song_id = key >> 32
+            if song_id not in peaks or value > peaks[song_id]:
+                peaks[song_id] = value
+
+    def leader_margin(self):
+        """
+        how far the best song's score is ahead of the second best
+        """
+        top_two = heapq.nlargest(2, self.peaks.values())
+        if len(top_two) == 0:
+            return 0
+        return top_two[0] - (top_two[1] if len(top_two) == 2 else 0)
+
+    def scores(self) -> list[tuple[int, int]]:
+        """
+        `[(top_song_id, top_song_score), (2nd_song_id, 2nd_song_score), ...]`, like `score_hashes()`
+        (ties in song id order)
+        """
+        return sorted(self.peaks.items(), key=lambda item: (-item[1], item[0]))
+
+    def time_pair_bins(self) -> "TimePairBins":
+        song_ids, source_times, sample_times = (
+            np.concatenate([np.empty(0, dtype=np.int64)] + chunks)
+            for chunks in (self.song_id_chunks, self.source_time_chunks, self.sample_time_chunks)
+        )
+        order = np.argsort(song_ids, kind="stable")
+        candidate_ids, song_index = np.unique(song_ids[order], return_inverse=True)
+        return TimePairBins(candidate_ids, song_index, source_times[order], sample_times[order])
+
+
+class TimePairBins(Mapping):
+    """
+    read-only `{song_id: {(sourceT, sampleT), ...}}` returned by `score_hashes()`,
+    a song's set is only built when it is accessed
+
+    candidate_ids: sorted song ids, the time pairs of `candidate_ids[i]` are the
+    `source_times`, `sample_times` entries where `song_index == i` (sorted by song_index)
+    """
+
+    def __init__(self, candidate_ids: np.ndarray, song_index: np.ndarray,
+                 source_times: np.ndarray, sample_times: np.ndarray):
+        self.candidate_ids = candidate_ids
+        self.bounds = np.searchsorted(song_index, np.arange(len(candidate_ids) + 1))
+        self.source_times = source_times
+        self.sample_times = sample_times
+
+    def __getitem__(self, song_id: int) -> set[tuple[int, int]]:
+        i = np.searchsorted(self.candidate_ids, song_id)
+        if i == len(self.candidate_ids) or self.candidate_ids[i] != song_id:
+            raise KeyError(song_id)
+        rows = slice(self.bounds[i], self.bounds[i + 1])
+        return set(zip(self.source_times[rows].tolist(), self.sample_times[rows].tolist()))
+
+    def __iter__(self):
+        return iter(self.candidate_ids.tolist())
+
+    def __len__(self) -> int:
+        return len(self.candidate_ids)
+
+
+class QueryBatcher:
+    """
+    looks up the hashes of concurrent queries together: the samples submitted within
+    a short window (`window_s`, default `query_batch_window_s`) are merged, each distinct
+    address is looked up once for the whole batch (in `fingerprint_index.index`, or
+    SQLite when it is `None`), and every sample is then scored against the batch's postings
+
+    ```
+    batcher = QueryBatcher()
+
+    # from any number of threads, e.g. one per request
+    scores = batcher.score(create_hashes(constellation_map, sr), top_k=5)
+    ```
+
+    a query waits at most `window_s` plus one batch lookup for its postings, so under load
+    the database sees one lookup per batch instead of one per request, with bounded latency
+    """
+
+    def __init__(self, window_s: float = None, max_batch: int = None):
+        self.window_s = query_batch_window_s if window_s is None else window_s
+        self.max_batch = max_batch or max_query_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self._thread.start()
+
+    @metrics.stage("lookup")
+    def lookup(self, hash_vals: np.ndarray) -> fingerprint_index.MemoryIndex:
+        """
+        returns the postings of the batch `hash_vals` was submitted with, as a small
+        in-memory index (with the `n_songs` of the whole library, for IDF weights)
+        """
+        future = Future()
+        self._queue.put((hash_vals, future))
+        return future.result()
+
+    def score(self, hashes: tuple[np.ndarray, np.ndarray], top_k: int = None,
+              max_df: int = None, idf: bool = None) -> list[tuple[int, int]]:
+        """
+        `score_hashes()` scores of `hashes` (the `top_k` best ones), with the lookup batched
+        (none on a `result_cache` hit, see `score_hashes_cached()`)
+        """
+        scores = score_hashes_cached(hashes, max_df=max_df, idf=idf, lookup=lambda: self.lookup(hashes[0]))
+        return scores[:top_k]
+
+    def close(self) -> None:
+        """
+        stops the batching thread once the queries already submitted are answered
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while (query := self._queue.get()) is not None:
+            # collect the queries arriving until the window closes or the batch is full
+            batch = [query]
+            deadline = time.monotonic() + self.window_s
+            while len(batch) < self.max_batch and (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    query = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if query is None:
+                    self._queue.put(None)  # stop after this batch
+                    break
+                batch.append(query)
+            self._lookup_batch(batch)
+
+    def _lookup_batch(self, batch: list[tuple[np.ndarray, Future]]) -> None:
+        try:
+            hash_vals = np.unique(np.concatenate([np.asarray(h, dtype=np.uint32) for h, _ in batch]))
+            index = fingerprint_index.index
+            if index is not None:
+                postings, n_songs = index.lookup(hash_vals), index.n_songs
+            else:
+                with reader() as con:
+                    cur = con.cursor()
+                    postings, n_songs = retrieve_postings(hash_vals, cur), count_songs(cur)
+            # every posting of each address, so document frequencies computed from
+            # the batch index are those of the library (see match_time_pairs())
+            batch_index = fingerprint_index.MemoryIndex(*postings)
+            batch_index.n_songs = n_songs
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for _, future in batch:
+            future.set_result(batch_index)
+
+
+def minhash_signature(hash_vals: np.ndarray, n_permutations: int = None) -> np.ndarray:
+    """
+    MinHash signature of the set of addresses `hash_vals`: for each of `n_permutations`
+    (default `minhash_permutations`) random hash functions, the smallest hash of the set
+
+    two sets agree at each position of their signatures with a probability equal to
+    their Jaccard similarity `|A & B| / |A | B|`, so the fraction of equal positions estimates it
+    """
+    n_permutations = n_permutations or minhash_permutations
+    seeds = np.random.default_rng(0).integers(0, 2**63, size=n_permutations, dtype=np.uint64)
+    h = np.unique(np.asarray(hash_vals, dtype=np.uint64))[None, :] ^ seeds[:, None]
+    # splitmix64 finalizer: a different pseudo-random permutation of the addresses per seed
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    h ^= h >> np.uint64(31)
+    return h.min(axis=1, initial=np.iinfo(np.uint64).max)
+
+
+class ResultCache:
+    """
+    scores of recent queries, found by the MinHash signature of their addresses
+    (see `minhash_signature()`), so a repeated upload of the same clip, or a clip with
+    nearly the same hash set, is answered without looking up its hashes
+
+    ```
+    signature = minhash_signature(hash_vals)
+    scores = cache.get(signature, key)     # None on a miss
+    cache.put(signature, key, scores)
+    ```
+
+    `key` separates results that are not interchangeable (library, scoring settings)
+
+    signatures are split into bands of `band_size` positions, an entry sharing a band with
+    the query is a candidate (locality-sensitive hashing), and the most similar candidate
+    is returned if at least `min_similarity` of the positions are equal. Entries expire
+    `ttl_s` seconds after they were stored, the least recently used one is evicted
+    beyond `max_entries`
+    """
+
+    def __init__(self, max_entries: int = None, ttl_s: float = None,
+                 band_size: int = 4, min_similarity: float = 0.9):
+        self.max_entries = result_cache_size if max_entries is None else max_entries
+        self.ttl_s = result_cache_ttl_s if ttl_s is None else ttl_s
+        self.band_size = band_size
+        self.min_similarity = min_similarity
+        self._entries = OrderedDict()  # {entry_id: (band_keys, signature, scores, expires)}, least recently used first
+        self._bands = {}               # {(key, band index, band bytes): entry_id}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _band_keys(self, signature: np.ndarray, key) -> list[tuple]:
+        return [
+            (key, i, signature[start:start + self.band_size].tobytes())
+            for i, start in enumerate(range(0, len(signature), self.band_size))
+        ]
+
+    def _remove(self, entry_id: int) -> None:
+        band_keys = self._entries.pop(entry_id)[0]
+        for band_key in band_keys:
+            if self._bands.get(band_key) == entry_id:
+                del self._bands[band_key]
+
+    def get(self, signature: np.ndarray, key=None) -> list[tuple[int, int]]|None:
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_similarity = None, self.min_similarity
+            for band_key in self._band_keys(signature, key):
+                entry_id = self._bands.get(band_key)
+                if entry_id is None or entry_id not in self._entries:
+                    continue
+                _, entry_signature, _, expires = self._entries[entry_id]
+                if expires <= now:
+                    self._remove(entry_id)
+                    continue
+                similarity = np.mean(entry_signature == signature)
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is None:
+                return None
+            self._entries.move_to_end(best_id)
+            return list(self._entries[best_id][2])
+
+    def put(self, signature: np.ndarray, key, scores: list[tuple[int, int]]) -> None:
+        with self._lock:
+            entry_id = next(self._ids)
+            band_keys = self._band_keys(signature, key)
+            self._entries[entry_id] = (band_keys, signature, list(scores), time.monotonic() + self.ttl_s)
+            # the newest entry answers for its bands
+            for band_key in band_keys:
+                self._bands[band_key] = entry_id
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bands.clear()
+
+
+# cache used by score_hashes_cached(), None disables it
+result_cache = ResultCache()
+
+
+def invalidate_result_cache() -> None:
+    """
+    forgets every cached result, call after changing the songs in the library
+    """
+    if result_cache is not None:
+        result_cache.clear()
+
+
+def score_hashes_cached(hashes: tuple[np.ndarray, np.ndarray], index=None, max_df: int = None,
+                        idf: bool = None, lookup=None) -> list[tuple[int, int]]:
+    """
+    `score_hashes()` scores, taken from `result_cache` when a recent query had the same
+    or nearly the same set of addresses (see `ResultCache`)
+
+    `lookup`: function returning the index to score against, called only on a cache miss
+    (used by `QueryBatcher.score()`), instead of `index`
+    """
+    max_df = hash_max_df if max_df is None else max_df
+    idf = idf_weighting if idf is None else idf
+    if result_cache is None or not len(hashes[0]):
+        return score_hashes(hashes, lookup() if lookup else index, max_df, idf)[0]
+
+    key = (DBcontrol.library, max_df, idf)
+    signature = minhash_signature(hashes[0])
+    scores = result_cache.get(signature, key)
+    if scores is not None:
+        metrics.count("result_cache_hits", 1)
+    else:
+        scores = score_hashes(hashes, lookup() if lookup else index, max_df, idf)[0]
+        result_cache.put(signature, key, scores)
+    return scores
+
+
+def recognize_music(sample_audio_path: str, remove_sample: bool = True,
+                    progressive: bool = False, top_k: int = None) -> list[tuple[int, int]]:
     """
     returns sorted list of `(song_id, score)` tuples, access top prediction with `scores[0][0]`
 
+    `progressive=True` stops matching once one song is clearly ahead (see
+    `score_hashes_progressive()`), `top_k` keeps only the best `top_k` scores
+
     ```
     # add songs to db
     DBcontrol.add_songs(...)
@@ -120,10 +662,22 @@ def recognize_music(sample_audio_path: str, remove_sample: bool = True) -> list[
     song_id = recognize_music(sample_audio_path)[0][0]
     ```
     """
-    sample, sr = preprocess_audio(sample_audio_path)
+    # a sample that is removed after recognition would only fill the audio cache
+    sample, sr = preprocess_audio(sample_audio_path, use_cache=not remove_sample)
     # if remove_sample:
     #     os.remove(sample_audio_path)
+    return recognize_audio(sample, sr, progressive, top_k)
+
+
+def recognize_audio(sample: np.ndarray, sr: int, progressive: bool = False,
+                    top_k: int = None) -> tuple[list[tuple[int, int]], Mapping]:
+    """
+    `recognize_music()` of audio already in memory (e.g. from `cm_helper.decode_audio_bytes()`)
+    """
     constellation_map = create_constellation_map(sample, sr)
-    hashes = create_hashes(constellation_map, None, sr)
-    scores, time_pair_bins = score_hashes(hashes)
-    return scores, time_pair_bins
\ No newline at end of file
+    hashes = create_hashes(constellation_map, sr)
+    # in-memory index if it was loaded at startup, otherwise SQLite
+    if progressive:
+        return score_hashes_progressive(hashes, index=fingerprint_index.index, top_k=top_k)
+    scores, time_pair_bins = score_hashes(hashes, index=fingerprint_index.index)
+    return scores[:top_k], time_pair_bins
\ No newline at end of file
@@ -13,4 +13,11 @@ CREATE TABLE hashes(
     time_stamp INTEGER NOT NULL,
     song_id INTEGER NOT NULL,
     FOREIGN KEY (song_id) REFERENCES songs(id)
+);
+
+-- number of songs containing each hash value (its document frequency),
+-- kept up to date by DBcontrol.add_hashes(), used by search.py to skip or down-weight common hashes
+CREATE TABLE hash_df(
+    hash_val INTEGER PRIMARY KEY,
+    n_songs INTEGER NOT NULL
 );
\ No newline at end of file
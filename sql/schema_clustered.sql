@@ -0,0 +1,27 @@
+CREATE TABLE songs(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    youtube_url VARCHAR(64) UNIQUE NOT NULL,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    artwork_url TEXT NOT NULL,
+    audio_path TEXT NOT NULL,
+    duration_s FLOAT NOT NULL
+);
+
+-- hashes stored in a b-tree ordered by (hash_val, song_id, time_stamp):
+-- every row of a hash value is next to each other, and a lookup by hash_val
+-- is answered from the table b-tree alone (no separate index, no rowid jump)
+CREATE TABLE hashes(
+    hash_val INTEGER NOT NULL,
+    time_stamp INTEGER NOT NULL,
+    song_id INTEGER NOT NULL,
+    PRIMARY KEY (hash_val, song_id, time_stamp),
+    FOREIGN KEY (song_id) REFERENCES songs(id)
+) WITHOUT ROWID;
+
+-- number of songs containing each hash value (its document frequency),
+-- kept up to date by DBcontrol.add_hashes(), used by search.py to skip or down-weight common hashes
+CREATE TABLE hash_df(
+    hash_val INTEGER PRIMARY KEY,
+    n_songs INTEGER NOT NULL
+);
\ No newline at end of file
@@ -0,0 +1,101 @@
+import numpy as np
+
+import search
+import fingerprint_index
+from cm_helper import StreamingSTFT
+from const_map import StreamingPeakFinder
+from hasher import StreamingHasher
+
+
+class StreamingRecognizer:
+    """
+    recognizes a song from audio that arrives in chunks (a microphone, a chunked upload),
+    reporting a match as soon as one song is clearly ahead instead of after the whole clip
+
+    ```
+    recognizer = StreamingRecognizer(input_sr=44100)
+    for chunk in chunks:                   # mono float audio
+        match = recognizer.push(chunk)
+        if match is not None:
+            song_id, score = match
+            break
+    scores = recognizer.finish()           # [(song_id, score), ...] like recognize_music()
+    ```
+
+    each chunk goes through the incremental versions of the pipeline
+    (`StreamingSTFT`, `StreamingPeakFinder`, `StreamingHasher`); the new hashes are matched
+    with `search.match_time_pairs()` and added to a running `search.OffsetHistogram`.
+    After `finish()`, the scores are the same as `recognize_music()` of the whole clip
+    (resampled the same way)
+
+    `input_sr`: sampling rate of the pushed audio, resampled to `sr` (11025, as `preprocess_audio()`)
+
+    `index`: where to look up hashes, `None` (default) uses `fingerprint_index.index`
+    if one was loaded, otherwise SQLite
+
+    `margin`: a match is reported once the best song is `margin` points ahead of the second,
+    `None` (default) uses `search.progressive_margin`. `max_df`, `idf` as in `search.score_hashes()`
+    """
+
+    def __init__(self, input_sr: int = 11025, sr: int = 11025, index=None,
+                 margin: int = None, max_df: int = None, idf: bool = None):
+        self.sr = sr
+        self.resampler = None
+        if input_sr != sr:
+            import soxr
+            self.resampler = soxr.ResampleStream(input_sr, sr, 1, dtype="float32")
+
+        self.stft = StreamingSTFT(sr)
+        self.peak_finder = StreamingPeakFinder(self.stft.frequencies)
+        self.hasher = StreamingHasher(sr)
+
+        self.index = fingerprint_index.index if index is None else index
+        self.margin = search.progressive_margin if margin is None else margin
+        self.max_df = search.hash_max_df if max_df is None else max_df
+        self.idf = search.idf_weighting if idf is None else idf
+        # the anchors of new hashes are at most fanout_t frames before the latest peak,
+        # so time pairs can only repeat within that window
+        self.histogram = search.OffsetHistogram(weighted=self.idf, dedupe_window=self.hasher.fanout_t)
+
+        self.n_samples = 0   # samples pushed, after resampling
+        self.match = None    # (song_id, score), once reported
+
+    @property
+    def seconds(self) -> float:
+        """
+        seconds of audio received so far
+        """
+        return self.n_samples / self.sr
+
+    def push(self, audio: np.ndarray) -> tuple[int, int]|None:
+        """
+        returns `(song_id, score)` once one song is `margin` points ahead, otherwise `None`
+        """
+        if self.resampler is not None:
+            audio = self.resampler.resample_chunk(np.asarray(audio, dtype=np.float32))
+        self.n_samples += len(audio)
+        self._add_peaks(self.peak_finder.push(self.stft.push(audio)))
+        return self.match
+
+    def finish(self) -> list[tuple[int, int]]:
+        """
+        processes the end of the audio and returns every score, sorted
+        """
+        if self.resampler is not None:
+            audio = self.resampler.resample_chunk(np.empty(0, dtype=np.float32), last=True)
+            self.n_samples += len(audio)
+            self._add_peaks(self.peak_finder.push(self.stft.push(audio)))
+        self._add_peaks(self.peak_finder.push(self.stft.finish(), final=True))
+        return self.histogram.scores()
+
+    def _add_peaks(self, peaks: tuple[np.ndarray, np.ndarray]) -> None:
+        hashes = self.hasher.push(*peaks)
+        if len(hashes[0]) == 0:
+            return
+        candidate_ids, song_index, source_times, sample_times, weights = search.match_time_pairs(
+            hashes, self.index, None, self.max_df, self.idf
+        )
+        # the anchors of new hashes can be old peaks, so a time pair can repeat across calls
+        self.histogram.add(candidate_ids[song_index], source_times, sample_times, weights)
+        if self.match is None and self.histogram.leader_margin() >= self.margin:
+            self.match = self.histogram.scores()[0]
@@ -0,0 +1,105 @@
+import numpy as np
+
+import DBcontrol
+import DB_adder
+import cache
+import fingerprint_index
+import search
+
+# run with `python -m pytest test_db_adder.py`, uses a temporary library and no network
+
+songs = ["audio_samples/sample.wav", "audio_samples/Dogtooth_rec.flac"]
+
+
+def track_info(i: int) -> dict:
+    return {
+        "youtube_url": f"test_{i}",
+        "title": f"song {i}",
+        "artist": "test",
+        "artwork_url": "",
+        "audio_path": songs[i],
+    }
+
+
+def test_add_song_updates_library_and_caches(tmp_path, monkeypatch):
+    monkeypatch.setattr(DBcontrol, "library", str(tmp_path / "library.db"))
+    monkeypatch.setattr(cache, "cache_dir", None)
+    monkeypatch.setattr(fingerprint_index, "index", None)
+    monkeypatch.setattr(search, "result_cache", search.ResultCache())
+    DBcontrol.create_tables()
+
+    first_id = DB_adder.add_song(track_info(0))
+    assert DB_adder.check_if_song_exists("test_0")
+    assert not DB_adder.check_if_song_exists("test_1")
+    fingerprint_index.load_memory_index()
+    assert fingerprint_index.index.n_songs == 1
+
+    # fill the metadata and query result caches with the one-song library
+    audio, sr = DB_adder.preprocess_audio(songs[1], use_cache=False)
+    hashes = DB_adder.create_hashes(DB_adder.create_constellation_map(audio, sr), sr)
+    assert DBcontrol.retrieve_songs([first_id, first_id + 1]).keys() == {first_id}
+    scores_before = search.score_hashes_cached(hashes, fingerprint_index.index)
+    assert len(search.result_cache) == 1
+
+    song_id = DB_adder.add_song(track_info(1))
+    assert song_id != first_id
+
+    # hashes table and document frequencies
+    with DBcontrol.reader() as con:
+        cur = con.cursor()
+        n_hashes = cur.execute("SELECT COUNT(*) FROM hashes WHERE song_id = ?", (song_id,)).fetchone()[0]
+        df_hash_vals, df = DBcontrol.retrieve_hash_df(hashes[0], cur)
+    assert n_hashes > 0
+    assert df.min() >= 1 and df.max() == 2
+
+    # in-memory index, metadata cache, result cache
+    assert fingerprint_index.index.n_songs == 2
+    assert song_id in fingerprint_index.index.lookup(hashes[0])[1]
+    assert DBcontrol.retrieve_songs([song_id])[song_id]["title"] == "song 1"
+    assert len(search.result_cache) == 0
+    scores_after = search.score_hashes_cached(hashes, fingerprint_index.index)
+    assert scores_after[0][0] == song_id
+    assert scores_after != scores_before
+
+    # adding the same song again changes nothing
+    assert DB_adder.add_song(track_info(1)) == song_id
+    assert fingerprint_index.index.n_songs == 2
+    with DBcontrol.reader() as con:
+        assert con.execute("SELECT MAX(n_songs) FROM hash_df").fetchone()[0] == 2
+
+    DBcontrol.close_pool()
+
+
+def test_create_tables_clears_result_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(DBcontrol, "library", str(tmp_path / "library.db"))
+    monkeypatch.setattr(search, "result_cache", search.ResultCache())
+    signature = search.minhash_signature(np.arange(100))
+    search.result_cache.put(signature, (DBcontrol.library, None, False), [(1, 10)])
+
+    DBcontrol.create_tables()
+    assert len(search.result_cache) == 0
+    DBcontrol.close_pool()
+
+
+def test_fingerprinting_again_keeps_document_frequencies(tmp_path, monkeypatch):
+    monkeypatch.setattr(DBcontrol, "library", str(tmp_path / "library.db"))
+    monkeypatch.setattr(cache, "cache_dir", None)
+    monkeypatch.setattr(fingerprint_index, "index", None)
+    monkeypatch.setattr(search, "result_cache", search.ResultCache())
+    DBcontrol.create_tables()
+
+    song_id = DB_adder.add_song(track_info(0))
+    DBcontrol.compute_source_hashes([song_id])
+    with DBcontrol.reader() as con:
+        assert con.execute("SELECT MAX(n_songs) FROM hash_df").fetchone()[0] == 1
+
+    index = fingerprint_index.MemoryIndex.from_database()
+    audio, sr = DB_adder.preprocess_audio(songs[0], use_cache=False)
+    hashes = DB_adder.create_hashes(DB_adder.create_constellation_map(audio, sr), sr)
+    index.add(song_id, hashes)
+    assert index.n_songs == 1
+
+    # a hash found in every song of the library still has a weight
+    scores, _ = search.score_hashes(hashes, index=index, idf=True)
+    assert scores[0][0] == song_id and scores[0][1] > 0
+    DBcontrol.close_pool()